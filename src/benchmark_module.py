@@ -0,0 +1,458 @@
+import ast
+import importlib
+import inspect
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+
+import matplotlib.pyplot as plt
+import geopandas as gpd
+import pandas as pd
+
+import city_index_module as ci
+import clean_merge_module as cm
+import file_path as fp
+import map_module as mm
+
+### Benchmarks of the hot paths of clean_merge_module and map_module.
+### Every benchmark runs on the shipped data and on synthetic data with the urban centers
+### (and their cities) repeated 10x and 100x, and records the run time and the peak memory
+### traced by tracemalloc, so results saved before and after a change can be compared.
+
+## example usage of run_benchmarks, from the src directory
+# python benchmark_module.py --out ../data/benchmark_results/baseline.json
+# python benchmark_module.py --scales 1 10 --only merge_geo_df normalize_features
+# python benchmark_module.py --out ../data/benchmark_results/new.json --compare ../data/benchmark_results/baseline.json
+
+SCALES = [1, 10, 100]
+
+
+def scale_mh(mh_df, scale, place_col="PlaceName"):
+    """
+    Repeat the mental health cities scale times, copy i of a city is named "<city> <i>"
+    """
+    if scale == 1:
+        return mh_df.copy()
+    copies = []
+    for i in range(scale):
+        copy = mh_df.copy()
+        if i > 0:
+            copy[place_col] = copy[place_col] + f" {i}"
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def scale_uc(df, scale, group_col="UC_Grouping", name_cols=["Urban Center"], cities_col=None):
+    """
+    Repeat the urban centers scale times with new group keys,
+    copy i of an urban center and of its cities in cities_col is named "<name> <i>"
+    """
+    if scale == 1:
+        return df.copy()
+    offset = int(df[group_col].max()) + 1
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        copy[group_col] = copy[group_col] + i * offset
+        if i > 0:
+            for col in name_cols:
+                copy[col] = copy[col] + f" {i}"
+            if cities_col is not None:
+                copy[cities_col] = copy[cities_col].str.split("; ").apply(
+                    lambda cities: "; ".join(f"{c} {i}" for c in cities)
+                )
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def gs_clean_frame(gs_cleaned_path=fp.gs_cleaned):
+    """
+    Rebuild the cleaned urban center level greenspace dataframe, before the city matching step,
+    from the shipped greenspace_cleaned.csv, keeping its State, Region and Division columns
+    """
+    gs = pd.read_csv(gs_cleaned_path, index_col=0)
+    gs = gs.drop_duplicates("UC Grouping").drop(columns=["PlaceName"])
+    gs["Cities in Urban Center"] = gs.pop("Cities in Urban Center_copy")
+    return gs.set_index("UC Grouping", drop=False).rename_axis(None)
+
+
+def gs_raw_frame(gs_df, n_other=3):
+    """
+    Return a raw GHS-like dataframe with the GS_COLS_TO_KEEP columns from the cleaned greenspace dataframe,
+    plus n_other copies of every urban center in another country, as the full GHS file is not shipped
+    """
+    inverse = {v: k for k, v in cm.GS_RENAME_COLS.items()}
+    raw = gs_df.rename(columns=inverse)[cm.GS_COLS_TO_KEEP]
+    others = [raw.assign(CTR_MN_NM=f"Country {i}") for i in range(n_other)]
+    return pd.concat([raw] + others, ignore_index=True)
+
+
+def state_geo_frame(geo_df, state_col="State"):
+    """
+    Dissolve the urban center footprints by state, a stand-in for the state geojson that is not shipped
+    """
+    states = geo_df[[state_col, "geometry"]].dropna().dissolve(by=state_col).reset_index()
+    return states.rename(columns={state_col: "STUSPS"})
+
+
+def build_datasets(scale, data_dir):
+    """
+    Write the scale-times data files used by the benchmarks to data_dir,
+    Return the dictionary of file paths and in-memory dataframes
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    mh_raw = cm.mh_remove_chronics(cm.load_file_df(fp.mh_file))
+    mh_cleaned = pd.read_csv(fp.mh_cleaned)
+    gs_df = gs_clean_frame()
+    merged = pd.read_csv(fp.merged_data_file, index_col=0)
+    geo_us = gpd.read_parquet(fp.geo_us_asset)
+
+    gs_df = scale_uc(gs_df, scale, group_col="UC Grouping", cities_col="Cities in Urban Center")
+    gs_df = gs_df.set_index("UC Grouping", drop=False).rename_axis(None)
+    merged = scale_uc(merged, scale)
+    geo_us = scale_uc(geo_us, scale, name_cols=[])
+
+    data = {
+        "mh_raw": scale_mh(mh_raw, scale),
+        "mh_cleaned": scale_mh(mh_cleaned, scale),
+        "gs_df": gs_df.drop(columns=["UC Grouping"]),
+        "merged_file": os.path.join(data_dir, "merged.csv"),
+        "geo_file": os.path.join(data_dir, "geo_us.parquet"),
+        "state_file": os.path.join(data_dir, "state.parquet"),
+        "gs_raw_file": os.path.join(data_dir, "gs_raw.csv"),
+    }
+    merged.to_csv(data["merged_file"])
+    geo_us.to_parquet(data["geo_file"], index=False)
+    gs_raw_frame(gs_df).to_csv(data["gs_raw_file"], index=False)
+    state_geo_frame(geo_us.merge(merged, on="UC_Grouping")).to_parquet(
+        data["state_file"], index=False
+    )
+    data["geo_df"] = mm.merge_geo_df(
+        data["geo_file"], data["merged_file"], "UC_Grouping", "UC_Grouping"
+    )
+    data["normalized_df"] = mm.normalize_features(data["geo_df"], "Avg Greenness")
+    data["features"] = json.loads(geo_us[["UC_Grouping", "geometry"]].to_json(drop_id=True))["features"]
+    return data
+
+
+class no_basemap:
+    """
+    Context manager replacing map_module.add_basemap and prefetch_basemap with no-ops, so renders don't load tiles
+    """
+
+    def __enter__(self):
+        self.add_basemap, self.prefetch_basemap = mm.add_basemap, mm.prefetch_basemap
+        mm.add_basemap = lambda ax, crs, source=None: None
+        mm.prefetch_basemap = lambda extent, crs, source=None: None
+        return self
+
+    def __exit__(self, *exc):
+        mm.add_basemap, mm.prefetch_basemap = self.add_basemap, self.prefetch_basemap
+        return False
+
+
+def bench_mh_clean_transfrom(data):
+    return cm.mh_clean_transfrom(
+        data["mh_raw"], col_lst=["PlaceFIPS", "MHLTH_CrudePrev", "MHLTH_Crude95CI"]
+    )
+
+
+def bench_gs_load_filter(data):
+    return cm.load_gs_csv(data["gs_raw_file"])
+
+
+def bench_city_match_aggregate(data):
+    mh_df = data["mh_cleaned"]
+    gs_df = ci.match_cities(data["gs_df"], mh_df)
+    return cm.aggregate_uc(cm.merge_mh_gs(mh_df, gs_df))
+
+
+def bench_merge_geo_df(data):
+    return mm.merge_geo_df(data["geo_file"], data["merged_file"], "UC_Grouping", "UC_Grouping")
+
+
+def bench_normalize_features(data):
+    return mm.normalize_features(data["geo_df"], "Avg Greenness")
+
+
+def bench_assign_color_cells(data):
+    return mm.assign_color_cells(data["normalized_df"], "Avg Greenness")
+
+
+def bench_tooltip_properties(data):
+    merged = pd.read_csv(data["merged_file"], index_col=0)
+    return mm.add_tooltip_properties(
+        data["features"], merged, "UC_Grouping", "UC_Grouping", ["Urban Center", "State", "MH_Score", "Avg Greenness"]
+    )
+
+
+def bench_render_bimap_state_level(data):
+    mm.invalidate_geo_cache()
+    with no_basemap():
+        mm.one_function_bimap_state_level(data["state_file"], data["merged_file"])
+    plt.close("all")
+
+
+def bench_render_monoMap_six_urban_centers(data):
+    mm.invalidate_geo_cache()
+    # the six panels of one_function_monoMap_six_urban_centers, rendered in this process (n_jobs=1),
+    # as the no_basemap patch doesn't reach the worker processes
+    with no_basemap():
+        mm.monoMap_urban_centers(
+            data["geo_file"],
+            data["merged_file"],
+            ["Cary", "New Bedford", "Flint", "Winston-Salem", "Manchester", "Des Moines"],
+            grid=(2, 3),
+            fig_size=(18, 10),
+            legend_position=[-1.1, -1, 0.8, 0.8],
+            legend_panel=5,
+            n_jobs=1,
+        )
+    plt.close("all")
+
+
+BENCHMARKS = {
+    "mh_clean_transfrom": bench_mh_clean_transfrom,
+    "gs_load_filter": bench_gs_load_filter,
+    "city_match_aggregate": bench_city_match_aggregate,
+    "merge_geo_df": bench_merge_geo_df,
+    "normalize_features": bench_normalize_features,
+    "assign_color_cells": bench_assign_color_cells,
+    "tooltip_properties": bench_tooltip_properties,
+    "render_bimap_state_level": bench_render_bimap_state_level,
+    "render_monoMap_six_urban_centers": bench_render_monoMap_six_urban_centers,
+}
+
+
+def measure(func, data, repeat=5):
+    """
+    Run func(data) repeat times for the timings, then once more under tracemalloc for the peak memory,
+    Return the min and median time in seconds and the peak memory in MB
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_mb": peak / 2**20,
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(scales=SCALES, only=None, repeat=5, out_path=None):
+    """
+    Run the benchmarks at every scale.
+
+    Parameters:
+        scales: list of int, the urban center multipliers of the synthetic data, 1 is the shipped data
+        only: list of str, the benchmark names to run, all benchmarks if None
+        repeat: int, the number of timed runs of every benchmark
+        out_path: str, the json file the results are saved to
+    Return the list of results.
+    """
+    names = list(BENCHMARKS) if only is None else only
+    results = []
+    print("It may take several minutes at the 100x scale.")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            data = build_datasets(scale, os.path.join(tmp_dir, f"x{scale}"))
+            for name in names:
+                result = dict(name=name, scale=scale, **measure(BENCHMARKS[name], data, repeat))
+                results.append(result)
+                print(
+                    f"{name:<36} x{scale:<4} min {result['min_s'] * 1000:10.1f} ms"
+                    f"  median {result['median_s'] * 1000:10.1f} ms  peak {result['peak_mb']:8.1f} MB"
+                )
+            shutil.rmtree(os.path.join(tmp_dir, f"x{scale}"))
+
+    if out_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        with open(out_path, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def compare_results(results, baseline_path):
+    """
+    Print the time and peak memory ratio of every result to the same benchmark and scale in the baseline file
+    """
+    with open(baseline_path) as f:
+        baseline = {(r["name"], r["scale"]): r for r in json.load(f)}
+    for result in results:
+        base = baseline.get((result["name"], result["scale"]))
+        if base is None:
+            continue
+        print(
+            f"{result['name']:<36} x{result['scale']:<4} time {result['min_s'] / base['min_s']:6.2f}x"
+            f"  peak {result['peak_mb'] / max(base['peak_mb'], 1e-9):6.2f}x"
+        )
+    return None
+
+
+### Below run_cold_start measures the cold-start latency of the public functions of clean_merge_module and map_module,
+### the time a new worker process or CLI invocation spends importing the module and the dependencies a function
+### imports on its first call, like contextily for the basemaps, in a fresh interpreter for every measurement.
+
+## example usage of run_cold_start, from the src directory
+# python benchmark_module.py --cold-start --out ../data/benchmark_results/cold_start.json
+
+COLD_START_MODULES = ["clean_merge_module", "map_module"]
+COLD_START_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+missing = []
+for name in {imports!r}:
+    try:
+        __import__(name)
+    except ImportError:
+        missing.append(name)
+first_use = time.perf_counter()
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([imported - start, first_use - imported, peak_kb / 1024, missing]))
+"""
+
+
+def project_modules(module):
+    """
+    Return the module and the modules of the src directory it imports
+    """
+    src_dir = os.path.dirname(os.path.abspath(module.__file__))
+    modules = [module]
+    for value in vars(module).values():
+        if inspect.ismodule(value) and value is not module and os.path.dirname(os.path.abspath(getattr(value, "__file__", None) or "")) == src_dir:
+            modules.append(value)
+    return modules
+
+
+def lazy_imports(func, modules, seen=None):
+    """
+    Return the modules imported inside func and inside the src functions it calls, loaded on its first call
+    """
+    seen = set() if seen is None else seen
+    if (func.__module__, func.__name__) in seen:
+        return []
+    seen.add((func.__module__, func.__name__))
+    imports = []
+    for node in ast.walk(ast.parse(textwrap.dedent(inspect.getsource(func)))):
+        if isinstance(node, ast.Import):
+            imports += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            imports.append(node.module)
+    for name in func.__code__.co_names:
+        for module in modules:
+            called = getattr(module, name, None)
+            if inspect.isfunction(called) and called.__module__ == module.__name__:
+                imports += lazy_imports(called, project_modules(module), seen)
+    return list(dict.fromkeys(imports))
+
+
+def public_functions(module):
+    """
+    Return the public functions defined in the module, by name
+    """
+    return {
+        name: func
+        for name, func in inspect.getmembers(module, inspect.isfunction)
+        if not name.startswith("_") and func.__module__ == module.__name__
+    }
+
+
+def cold_start(module_name, imports=(), repeat=5):
+    """
+    Import the module, then the lazy imports, in repeat fresh interpreters,
+    Return the min and median total time in seconds, the min import and first use times, the peak memory in MB
+    and the lazy imports that are not installed
+    """
+    script = COLD_START_SCRIPT.format(module=module_name, imports=list(imports))
+    env = dict(os.environ, MPLBACKEND="Agg")
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    totals = [run[0] + run[1] for run in runs]
+    return {
+        "min_s": min(totals),
+        "median_s": statistics.median(totals),
+        "import_s": min(run[0] for run in runs),
+        "first_use_s": min(run[1] for run in runs),
+        "peak_mb": max(run[2] for run in runs),
+        "missing": runs[0][3],
+        "repeat": repeat,
+    }
+
+
+def run_cold_start(modules=COLD_START_MODULES, repeat=5, out_path=None):
+    """
+    Measure the cold-start latency of every public function of the modules,
+    functions with the same lazy imports share one measurement.
+    Return the list of results, named "<module>.<function>" at scale 1 so they compare like run_benchmarks results.
+    """
+    results = []
+    for module_name in modules:
+        module = importlib.import_module(module_name)
+        measured = {}
+        for name, func in public_functions(module).items():
+            imports = tuple(lazy_imports(func, project_modules(module)))
+            if imports not in measured:
+                measured[imports] = cold_start(module_name, imports, repeat)
+            result = dict(name=f"{module_name}.{name}", scale=1, imports=list(imports), **measured[imports])
+            results.append(result)
+            print(
+                f"{result['name']:<56} import {result['import_s'] * 1000:8.1f} ms"
+                f"  first use {result['first_use_s'] * 1000:8.1f} ms  peak {result['peak_mb']:8.1f} MB"
+            )
+
+    if out_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        with open(out_path, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    parser = argparse.ArgumentParser(description="Benchmark the cleaning and mapping hot paths")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="json file to save the results to")
+    parser.add_argument("--compare", help="json results file to compare against")
+    parser.add_argument("--cold-start", action="store_true", help="measure the cold-start latency of the public functions instead")
+    args = parser.parse_args()
+    if args.cold_start:
+        results = run_cold_start(repeat=args.repeat, out_path=args.out)
+    else:
+        results = run_benchmarks(args.scales, args.only, args.repeat, args.out)
+    if args.compare:
+        compare_results(results, args.compare)
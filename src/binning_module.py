@@ -0,0 +1,127 @@
+import numpy as np
+
+### Vectorized class binning for the choropleth maps.
+### Breaks are the upper bounds of the classes, a value x falls in the first class whose break is >= x,
+### the same rule as the assign_color_num helpers of map_module.
+
+## example usage of classify
+# breaks = bin_breaks(df[["Avg Greenness", "MH_Score"]].to_numpy(), scheme="quantile", k=3)
+# classes = classify(df[["Avg Greenness", "MH_Score"]].to_numpy(), breaks)
+
+
+def user_breaks(values, breaks):
+    """
+    Return the user-specified breaks as a sorted float array
+    """
+    return np.sort(np.asarray(breaks, dtype=float), axis=0)
+
+
+def quantile_breaks(values, k=5):
+    """
+    Return the k quantile breaks of values, one column of breaks per column of values
+    """
+    return np.nanquantile(np.asarray(values, dtype=float), np.linspace(1 / k, 1, k), axis=0)
+
+
+def equal_interval_breaks(values, k=5):
+    """
+    Return k breaks splitting the range of values into equal intervals, one column of breaks per column of values
+    """
+    values = np.asarray(values, dtype=float)
+    min_value = np.nanmin(values, axis=0)
+    max_value = np.nanmax(values, axis=0)
+    steps = np.linspace(1 / k, 1, k).reshape((-1,) + (1,) * (values.ndim - 1))
+    breaks = min_value + (max_value - min_value) * steps
+    # avoid rounding the maximum out of the last class
+    breaks[-1] = max_value
+    return breaks
+
+
+def jenks_breaks(values, k=5):
+    """
+    Return the k Jenks natural breaks of values, one column of breaks per column of values.
+    Fisher's exact optimization: the breaks minimize the sum of squared deviations within the classes.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim > 1:
+        return np.stack([jenks_breaks(values[:, j], k) for j in range(values.shape[1])], axis=1)
+
+    x = np.sort(values[~np.isnan(values)])
+    n = len(x)
+    if n == 0:
+        return np.full(k, np.nan)
+
+    # prefix sums give the squared deviation of any segment x[i:j] in constant time
+    s1 = np.concatenate([[0.0], np.cumsum(x)])
+    s2 = np.concatenate([[0.0], np.cumsum(x * x)])
+
+    n_classes = min(k, n)
+    cost = np.full((n_classes + 1, n + 1), np.inf)
+    cost[0, 0] = 0
+    start = np.zeros((n_classes + 1, n + 1), dtype=int)
+    for c in range(1, n_classes + 1):
+        for j in range(c, n + 1):
+            i = np.arange(c - 1, j)
+            ssd = s2[j] - s2[i] - (s1[j] - s1[i]) ** 2 / (j - i)
+            candidates = cost[c - 1, i] + ssd
+            best = np.argmin(candidates)
+            cost[c, j] = candidates[best]
+            start[c, j] = i[best]
+
+    ends = [n]
+    for c in range(n_classes, 1, -1):
+        ends.append(start[c, ends[-1]])
+    breaks = x[np.array(ends[::-1]) - 1]
+    # fewer values than classes: repeat the last break so every scheme returns k breaks
+    return np.concatenate([breaks, np.repeat(breaks[-1], k - n_classes)])
+
+
+BREAK_SCHEMES = {
+    "user": user_breaks,
+    "quantile": quantile_breaks,
+    "equal_interval": equal_interval_breaks,
+    "jenks": jenks_breaks,
+}
+
+
+def bin_breaks(values, scheme="user", k=5, breaks=None):
+    """
+    Return the breaks of values for the scheme: user, quantile, equal_interval or jenks.
+    The user scheme returns breaks as given, the other schemes compute k breaks from values.
+    """
+    if scheme not in BREAK_SCHEMES:
+        raise ValueError(f"scheme must be one of {list(BREAK_SCHEMES)}, got {scheme}")
+    if scheme == "user":
+        return user_breaks(values, breaks)
+    return BREAK_SCHEMES[scheme](values, k)
+
+
+def classify(values, breaks, reverse=False, clip=False, nan_class=-1):
+    """
+    Return the class index of every value, for a whole column or many columns at once.
+
+    Parameters:
+        values: array, 1d column or 2d (rows, columns) array of values
+        breaks: array, the sorted upper bounds of the classes,
+            1d breaks are shared by all columns, 2d (breaks, columns) breaks are per column
+        reverse: bool, number the classes from the highest break down, like assign_color_num
+        clip: bool, put values above the last break in the last class instead of nan_class
+        nan_class: int, the class of NaN values and, unless clip, of values above the last break
+    """
+    values = np.asarray(values, dtype=float)
+    breaks = np.asarray(breaks, dtype=float)
+    n_breaks = breaks.shape[0]
+
+    if breaks.ndim == 1:
+        classes = np.searchsorted(breaks, values, side="left")
+    else:
+        # count the breaks strictly below each value, column by column, in one broadcast
+        classes = (values[..., np.newaxis] > breaks.T).sum(axis=-1)
+
+    if clip:
+        classes = np.minimum(classes, n_breaks - 1)
+    invalid = np.isnan(values) | (classes >= n_breaks)
+    if reverse:
+        classes = n_breaks - 1 - classes
+    classes[invalid] = nan_class
+    return classes
@@ -0,0 +1,149 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+import pandas as pd
+
+### Hash index of the city names of the greenspace urban centers.
+### Names are folded into keys that ignore case, accents, apostrophes, "St." abbreviations and encoding damage,
+### and bracketed alternates like "Minneapolis [Saint Paul]" are indexed under every name they hold,
+### so matching a mental health city to its urban center is one dictionary lookup per (city, state).
+
+## example usage of match_cities
+# city_index = build_city_index(gs_df)
+# matched_df = match_cities(gs_df, mh_df, city_index)
+
+APOSTROPHES = "'’‘`´ʼ"
+ALTERNATE_PATTERN = re.compile(r"\s*[\[\(]([^\]\)]*)[\]\)]")
+LOST_APOSTROPHE_PATTERN = re.compile(r"(?<=\w)\?(?=\w)")
+ABBREVIATIONS = {"st.": "saint", "ste.": "sainte", "ft.": "fort", "mt.": "mount"}
+
+
+def fix_mojibake(name):
+    """
+    Undo UTF-8 text decoded as latin-1, like "Oâ\x80\x99Fallon" for "O’Fallon", other names are returned as is
+    """
+    try:
+        return name.encode("latin-1").decode("utf-8")
+    except UnicodeError:
+        return name
+
+
+@lru_cache(maxsize=4)
+def apostrophe_table(apostrophe):
+    return str.maketrans({c: apostrophe for c in APOSTROPHES})
+
+
+def fold_apostrophes(name, apostrophe="'"):
+    """
+    Replace the apostrophe variants, and the "?" left between letters by a lossy encoding, with apostrophe
+    """
+    if "?" in name:
+        name = LOST_APOSTROPHE_PATTERN.sub(apostrophe, name)
+    return name.translate(apostrophe_table(apostrophe))
+
+
+def city_key(name):
+    """
+    Return the matching key of a city name: lower case, without accents, apostrophes or repeated spaces,
+    and with abbreviations like "St." spelled out
+    """
+    if not name.isascii():
+        name = unicodedata.normalize("NFKD", fix_mojibake(name))
+        name = "".join(c for c in name if not unicodedata.combining(c))
+    name = fold_apostrophes(name, apostrophe="")
+    return " ".join(ABBREVIATIONS.get(word, word) for word in name.casefold().split())
+
+
+def name_variants(name):
+    """
+    Return the names held by a name with bracketed alternates,
+    "Minneapolis [Saint Paul]" gives "Minneapolis [Saint Paul]", "Minneapolis" and "Saint Paul"
+    """
+    if "[" not in name and "(" not in name:
+        return [name]
+    alternates = ALTERNATE_PATTERN.findall(name)
+    return [name, ALTERNATE_PATTERN.sub("", name)] + alternates
+
+
+@lru_cache(maxsize=1 << 16)
+def name_keys(name):
+    """
+    Return the unique matching keys of every variant of the name
+    """
+    return tuple(dict.fromkeys(city_key(variant) for variant in name_variants(name)))
+
+
+def primary_name(name):
+    """
+    Return the display name of an urban center: the name without its bracketed alternates and with folded apostrophes
+    """
+    name = fold_apostrophes(fix_mojibake(name))
+    return ALTERNATE_PATTERN.sub("", name).strip()
+
+
+def build_city_index(
+    gs_df,
+    city_col="Cities in Urban Center",
+    uc_col="Urban Center",
+    state_col="State",
+    sep=";",
+):
+    """
+    Build the dictionary of (city key, state) to the urban center row label, once for all lookups.
+    Every city of city_col and every name of uc_col is indexed, the first urban center listing a city wins.
+    """
+    index = {}
+    for col in [city_col, uc_col]:
+        for label, names, state in zip(gs_df.index, gs_df[col], gs_df[state_col]):
+            if not isinstance(names, str):
+                continue
+            for name in names.split(sep) if col == city_col else [names]:
+                for key in name_keys(name):
+                    index.setdefault((key, state), label)
+    return index
+
+
+def lookup_city(city_index, name, state):
+    """
+    Return the urban center row label of the city in the state, None if it is not indexed
+    """
+    for key in name_keys(name):
+        label = city_index.get((key, state))
+        if label is not None:
+            return label
+    return None
+
+
+def match_cities(
+    gs_df,
+    mh_df,
+    city_index=None,
+    place_col="PlaceName",
+    mh_state_col="StateAbbr",
+    city_col="Cities in Urban Center",
+    group_col="UC Grouping",
+):
+    """
+    Match every mental health city to its urban center with one index lookup.
+    Return one row per matched city: the urban center row, its row label as group_col,
+    city_col kept as city_col + "_copy", and the mental health city name as place_col.
+    """
+    if city_index is None:
+        city_index = build_city_index(gs_df, city_col=city_col)
+
+    cities = mh_df[[place_col, mh_state_col]].drop_duplicates()
+    labels = [
+        lookup_city(city_index, name, state)
+        for name, state in zip(cities[place_col], cities[mh_state_col])
+    ]
+    matched = pd.DataFrame({place_col: cities[place_col].to_numpy(), group_col: labels})
+    matched = matched[matched[group_col].notna()]
+    matched[group_col] = matched[group_col].astype(gs_df.index.dtype)
+
+    gs_rows = gs_df.rename(columns={city_col: city_col + "_copy"})
+    gs_rows.index.name = group_col
+    matched_df = matched.join(gs_rows, on=group_col)
+    # same row order as the exploded urban centers
+    matched_df = matched_df.sort_values(group_col, kind="stable").reset_index(drop=True)
+    return matched_df[[group_col] + list(gs_rows.columns) + [place_col]]
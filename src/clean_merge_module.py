@@ -1,15 +1,168 @@
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import os
 
-def load_file_df(file_path):
+import city_index_module as ci
+import spatial_index_module as si
+
+GS_COLS_TO_KEEP = [
+    "AREA",
+    "GCPNT_LAT",
+    "GCPNT_LON",
+    "CTR_MN_NM",
+    "UC_NM_MN",
+    "UC_NM_LST",  # general
+    "E_BM_NM_LST",
+    "E_SL_LST",
+    "EL_AV_ALS",
+    "E_WR_P_14",
+    "E_WR_T_14",
+    "E_GR_AV14",
+    "E_GR_AT14",  # geography
+    "P15",
+    "B15",
+    "BUCAP15",
+    "NTL_AV",
+    "GDP15_SM",  # socio
+    "E_EC2E_R15",
+    "E_EC2E_I15",
+    "E_EC2E_T15",
+    "E_EC2E_A15",
+    "E_EC2O_R15",
+    "E_EC2O_I15",  # emissions1
+    "E_EC2O_A15",
+    "E_EPM2_R15",
+    "E_EPM2_I15",
+    "E_EPM2_T15",
+    "E_EPM2_A15",
+    "E_CPM2_T14",  # emissions2
+    "SDG_A2G14",
+    "SDG_OS15MX",
+    "SDG_LUE9015",
+    "EX_HW_IDX",  # landuse
+]
+
+GS_RENAME_COLS = {
+    "AREA": "Urban Center Area",
+    "GCPNT_LAT": "Latitude",
+    "GCPNT_LON": "Longitude",
+    "CTR_MN_NM": "Country",
+    "UC_NM_MN": "Urban Center",
+    "UC_NM_LST": "Cities in Urban Center",
+    "E_BM_NM_LST": "Biome",
+    "E_SL_LST": "Soil Group",
+    "EL_AV_ALS": "Avg Elevation",
+    "E_WR_P_14": "Avg Precipitation",
+    "E_WR_T_14": "Avg Temp",
+    "E_GR_AV14": "Avg Greenness",
+    "E_GR_AT14": "Total Green Area",
+    "P15": "Population",
+    "B15": "Total Built-up Area",
+    "BUCAP15": "Built-up Area per capita",
+    "NTL_AV": "Avg Nighttime Light Emission",
+    "GDP15_SM": "Sum of GDP",
+    "E_EC2E_R15": "TCNSCE Residential",  # TCNSCE stands for "total co2 non short cycle emissions"
+    "E_EC2E_I15": "TCNSCE Industry",
+    "E_EC2E_T15": "TCNSCE Transport",
+    "E_EC2E_A15": "TCNSCE Agriculture",
+    "E_EC2O_R15": "TCSCOE Residential",  # TCSCOE stands for "total co2 short cycle organic emissions"
+    "E_EC2O_I15": "TCSCOE Industry",
+    "E_EC2O_A15": "TCSCOE Agriculture",
+    "E_EPM2_R15": "Particulate Matter Emissions Residential",
+    "E_EPM2_I15": "Particulate Matter Emissions Industry",
+    "E_EPM2_T15": "Particulate Matter Emissions Transport",
+    "E_EPM2_A15": "Particulate Matter Emissions Agriculture",
+    "E_CPM2_T14": "Total Concertation of Particulate Matter",
+    "SDG_A2G14": "% of Pop in High Green Area",
+    "SDG_OS15MX": "% of Open Spaces",
+    "SDG_LUE9015": "Land Use Efficiency",
+    "EX_HW_IDX": "Max Magnitude of Heatwaves",
+}
+
+GS_STR_COLS = ["CTR_MN_NM", "UC_NM_MN", "UC_NM_LST", "E_BM_NM_LST", "E_SL_LST"]
+
+GS_NA_VALUES = ["?", "??", "???", "NAN"]
+
+# the full GHS UCDB files are not in the repository, the _short files shipped with it lack the attribute columns
+GS_DOWNLOAD_URL = "https://ghsl.jrc.ec.europa.eu/ghs_stat_ucdb2015mt_r2019a.php"
+
+STATE_BOUNDARIES_URL = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_state_500k.zip"
+
+UC_AGG_RULES = {
+    "MH_Population": "sum",
+    "MH_Score": ("weighted_mean", "MH_Population"),
+    "State": "first",
+    "Urban Center": "first",
+    "Biome": "first",
+    "Soil Group": "first",
+    "Cities in Urban Center_copy": "first",
+    "Region": "first",
+    "Division": "first",
+}
+
+MERGED_CATEGORICAL_COLS = ["State", "Biome", "Soil Group", "Region", "Division"]
+
+COLUMNAR_FORMATS = {".parquet": "parquet", ".feather": "feather", ".arrow": "feather"}
+
+
+def file_format(file_path):
+    """
+    Return the storage format of the file from its extension: parquet, feather or csv
+    """
+    return COLUMNAR_FORMATS.get(os.path.splitext(file_path)[1].lower(), "csv")
+
+
+def is_geoparquet(file_path):
+    """
+    Check whether the parquet file carries GeoParquet geometry metadata
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(file_path).metadata or {}
+    return b"geo" in metadata
+
+
+def require_file(file_path, download_url=None):
+    """
+    Raise a FileNotFoundError naming the missing file and where to download it from,
+    before it is read
+    """
+    if os.path.exists(file_path):
+        return file_path
+    message = f"{file_path} is missing"
+    if download_url is not None:
+        message += (
+            f", download {os.path.basename(file_path)} from {download_url}"
+            f" into {os.path.dirname(os.path.abspath(file_path))}"
+        )
+    raise FileNotFoundError(message)
+
+
+def load_file_df(file_path, columns=None):
     """
     Load the file from the file path.
     Return the dataframe.
+
+    Parquet and Feather (Arrow IPC) files keep their dtypes and categoricals,
+    and GeoParquet files are returned as a geodataframe.
+    Pass columns to only read those columns, the csv index column is then skipped too.
     """
-    df = pd.read_csv(file_path)
+    import geopandas as gpd
+
+    fmt = file_format(file_path)
+    if fmt == "parquet" and is_geoparquet(file_path):
+        df = gpd.read_parquet(file_path, columns=columns)
+    elif fmt == "parquet":
+        df = pd.read_parquet(file_path, columns=columns)
+    elif fmt == "feather":
+        df = pd.read_feather(file_path, columns=columns)
+    elif columns is not None:
+        df = pd.read_csv(file_path, usecols=lambda col: col in columns)[columns]
+    else:
+        df = pd.read_csv(file_path)
     return df
 
+
 def mh_remove_chronics(df, remove_key_words=["Crude", "Adj"], mh_key_words="MH"):
     """
     Remove columns with key words in remove_key_words and keep columns with key words in mh_key_words
@@ -24,29 +177,359 @@ def mh_remove_chronics(df, remove_key_words=["Crude", "Adj"], mh_key_words="MH")
     indf.drop(columns=remove_lst, inplace=True)
     return indf
 
+GEOLOCATION_PATTERN = (
+    r"([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*,\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)"
+)
+
+
+def parse_geolocation(series, lat_col="MH_Latitude", lon_col="MH_Longitude"):
+    """
+    Parse "(latitude, longitude)" strings with one regex pass.
+    Return a dataframe with the float64 lat_col and lon_col columns, NaN where the string can't be parsed.
+    """
+    coords = series.astype(str).str.extract(GEOLOCATION_PATTERN)
+    coords.columns = [lat_col, lon_col]
+    return coords.astype("float64")
+
+
 def mh_clean_transfrom(
-    df, col_lst=["MHLTH_CrudePrev", "MHLTH_Crude95CI"], trans_col="Geolocation"
+    df,
+    col_lst=["MHLTH_CrudePrev", "MHLTH_Crude95CI"],
+    trans_col="Geolocation",
+    lat_col="MH_Latitude",
+    lon_col="MH_Longitude",
+    geometry=False,
+):
+    """
+    Return a new dataframe with columns in col_lst removed and Geolocation replaced by
+    the float64 lat_col and lon_col columns, at the position of Geolocation.
+    When geometry is True, return a geodataframe with the city points built directly from the coordinates.
+    """
+    import geopandas as gpd
+
+    new_df = df.drop(columns=col_lst)
+    coords = parse_geolocation(new_df[trans_col], lat_col=lat_col, lon_col=lon_col)
+    position = new_df.columns.get_loc(trans_col)
+    new_df = new_df.drop(columns=[trans_col])
+    new_df.insert(position, lat_col, coords[lat_col])
+    new_df.insert(position + 1, lon_col, coords[lon_col])
+
+    if geometry:
+        points = gpd.points_from_xy(new_df[lon_col], new_df[lat_col], crs="EPSG:4326")
+        return gpd.GeoDataFrame(new_df, geometry=points)
+    return new_df
+
+
+def load_state_boundaries(file_path, cols=["STUSPS", "geometry"]):
+    """
+    Load the state boundaries shapefile once, keeping only the columns in cols.
+    Return the geodataframe of state polygons.
+    """
+    import geopandas as gpd
+
+    require_file(file_path, STATE_BOUNDARIES_URL)
+    state_gdf = gpd.read_file(file_path)
+    return state_gdf[cols]
+
+
+def assign_state(
+    df,
+    state_boundaries,
+    lon_col="Longitude",
+    lat_col="Latitude",
+    state_col="State",
+    state_key="STUSPS",
+):
+    """
+    Assign the state abbreviation to each row based on its longitude and latitude.
+    Return a new dataframe with state_col holding the state_key value, NaN if no state contains the point.
+
+    Points are built in one vectorized pass and matched with a single query against the
+    STRtree spatial index of the state polygons, instead of testing every state for every row.
+
+    Parameters:
+        df: dataframe with longitude and latitude columns
+        state_boundaries: str, geodataframe or SpatialIndex, the state boundaries file path,
+            the loaded state polygons or their spatial index.
+            The index of a file path is saved alongside the file and reused while the file is unchanged.
+        lon_col: str, the longitude column name
+        lat_col: str, the latitude column name
+        state_col: str, the name of the output state column
+        state_key: str, the state column in state_boundaries to return, STUSPS by default
+    """
+    if isinstance(state_boundaries, str):
+        require_file(state_boundaries, STATE_BOUNDARIES_URL)
+        state_index = si.load_or_build_index(state_boundaries, key_col=state_key)
+    elif isinstance(state_boundaries, si.SpatialIndex):
+        state_index = state_boundaries
+    else:
+        state_index = si.SpatialIndex.from_gdf(state_boundaries, state_key)
+
+    indf = df.copy()
+    # keep the first matching state of each point, like stateboundaries.contains(point).iloc[0]
+    indf[state_col] = state_index.first_containing(
+        indf[lon_col].to_numpy(), indf[lat_col].to_numpy(), missing=np.nan
+    )
+    return indf
+
+
+def gs_clean_transform(
+    df,
+    cols_to_keep=GS_COLS_TO_KEEP,
+    rename_cols=GS_RENAME_COLS,
+    country_col="CTR_MN_NM",
+    country="United States",
+    na_values=GS_NA_VALUES,
+):
+    """
+    Return a new dataframe with only the columns in cols_to_keep for the urban centers in country,
+    messy values in na_values replaced with NaN and columns renamed with rename_cols
+    """
+    gs_df = df[cols_to_keep]
+    gs_df = gs_df[gs_df[country_col] == country]
+    gs_df = gs_df.replace(to_replace=na_values, value=np.nan)
+    gs_df = gs_df.rename(columns=rename_cols)
+    return gs_df
+
+
+def load_gs_csv(
+    file_path,
+    cols_to_keep=GS_COLS_TO_KEEP,
+    rename_cols=GS_RENAME_COLS,
+    country_col="CTR_MN_NM",
+    country="United States",
+    str_cols=GS_STR_COLS,
+    na_values=GS_NA_VALUES,
+    encoding="unicode_escape",
+    chunksize=2000,
+    download_url=GS_DOWNLOAD_URL,
+):
+    """
+    Stream the raw GHS UCDB csv in chunks and keep only the urban centers in country,
+    Return the same dataframe as gs_clean_transform on the fully loaded file.
+
+    Only the columns in cols_to_keep are parsed, the str_cols are read as strings and
+    the other columns as float64, values that are not numbers becoming NaN,
+    so the peak memory follows the size of the country subset instead of the global file.
+    The row index of the file is kept, as it is the urban center key of the later steps.
+    """
+    require_file(file_path, download_url)
+    num_cols = [col for col in cols_to_keep if col not in str_cols]
+    chunks = pd.read_csv(
+        file_path,
+        usecols=cols_to_keep,
+        dtype={col: str for col in cols_to_keep if col in str_cols},
+        na_values=na_values,
+        encoding=encoding,
+        chunksize=chunksize,
+    )
+    kept = []
+    for chunk in chunks:
+        chunk = chunk[chunk[country_col] == country].copy()
+        chunk[num_cols] = chunk[num_cols].apply(pd.to_numeric, errors="coerce")
+        kept.append(chunk)
+    gs_df = pd.concat(kept)[cols_to_keep]
+    return gs_df.rename(columns=rename_cols)
+
+
+def load_gs_gpkg(
+    file_path,
+    cols_to_keep=GS_COLS_TO_KEEP,
+    rename_cols=GS_RENAME_COLS,
+    country_col="CTR_MN_NM",
+    country="United States",
+    na_values=GS_NA_VALUES,
+    layer=None,
+    download_url=GS_DOWNLOAD_URL,
 ):
     """
-    Return a new dataframe with columns in col_lst removed and Geolocation transformed to a list of float
+    Read the urban centers in country from the GHS UCDB GeoPackage,
+    Return the geodataframe with the columns in cols_to_keep, the geometry, and the columns renamed with rename_cols.
+
+    The country filter and the column selection are pushed down to the GeoPackage with pyogrio,
+    so the features of the other countries are never loaded.
     """
-    new_df = df.drop(columns=col_lst).copy()
-    new_df[trans_col] = new_df[trans_col].apply(
-        lambda x: x.replace("(", "").replace(")", "")
+    from pyogrio import read_dataframe
+
+    require_file(file_path, download_url)
+    country = country.replace("'", "''")
+    gs_gdf = read_dataframe(
+        file_path,
+        layer=layer,
+        columns=cols_to_keep,
+        where=f"{country_col} = '{country}'",
     )
-    new_df[trans_col] = new_df[trans_col].apply(lambda x: x.split(","))
-    new_df[trans_col] = new_df[trans_col].apply(lambda x: [float(x[0]), float(x[1])])
+    gs_gdf = gs_gdf.replace(to_replace=na_values, value=np.nan)
+    return gs_gdf.rename(columns=rename_cols)
+
+
+def gs_fix_city_names(df, uc_col="Urban Center", city_col="Cities in Urban Center"):
+    """
+    Return a new dataframe with the urban center names that can't be matched to the mental health dataset fixed:
+    apostrophes stored as "?" like "O?Fallon" are restored to "O'Fallon",
+    and bracketed alternates are dropped from the urban center name, "Minneapolis [Saint Paul]" becomes "Minneapolis"
+    """
+    indf = df.copy()
+    indf[uc_col] = indf[uc_col].map(ci.primary_name, na_action="ignore")
+    indf[city_col] = indf[city_col].map(ci.fold_apostrophes, na_action="ignore")
+    return indf
+
+
+def us_division():
+    """
+    Returns a dictionary of US divisions and their respective states.
+    """
+    us_divisions = {
+        "New England": ["CT", "ME", "MA", "NH", "RI", "VT"],
+        "Middle Atlantic": ["NJ", "NY", "PA"],
+        "East North Central": ["IL", "IN", "MI", "OH", "WI"],
+        "West North Central": ["IA", "KS", "MN", "MO", "NE", "ND", "SD"],
+        "South Atlantic": ["DE", "FL", "GA", "MD", "NC", "SC", "VA", "WV", "DC"],
+        "East South Central": ["AL", "KY", "MS", "TN"],
+        "West South Central": ["AR", "LA", "OK", "TX"],
+        "Mountain": ["AZ", "CO", "ID", "MT", "NV", "NM", "UT", "WY"],
+        "Pacific": ["AK", "CA", "HI", "OR", "WA"],
+    }
+    return us_divisions
+
+
+def us_region():
+    """
+    Returns a dictionary of US regions and their respective states.
+    """
+    us_regions = {
+        "West": ["AK", "AZ", "CA", "CO", "HI", "ID", "MT", "NV", "NM", "OR", "UT", "WA", "WY"],
+        "Midwest": ["IL", "IN", "IA", "KS", "MI", "MN", "MO", "NE", "ND", "OH", "SD", "WI"],
+        "Northeast": ["CT", "DE", "ME", "MD", "MA", "NH", "NJ", "NY", "PA", "RI", "VT"],
+        "South": ["AL", "AR", "FL", "GA", "KY", "LA", "MS", "NC", "OK", "SC", "TN", "TX", "VA", "WV", "DC"],
+    }
+    return us_regions
 
+
+def apply_geo_labels(df, label_col_name, label_dict, base_col):
+    """
+    Apply labels based on existing column.
+    Input df, name for labeled column, label dictionary, and based column.
+    Returns the dataframe with the labeled column.
+    """
+    new_df = df.copy()
+    new_df[label_col_name] = ["None" for x in range(len(df))]
+    for key, value in label_dict.items():
+        new_df.loc[new_df[base_col].isin(value), label_col_name] = key
     return new_df
 
-def save_csv(df, file_path):
+
+def merge_mh_gs(
+    mh_df,
+    gs_df,
+    mh_rename_cols={
+        "StateAbbr": "State",
+        "Population2010": "MH_Population",
+        "MHLTH_AdjPrev": "MH_Score",
+    },
+    mh_drop_cols=["MH_Latitude", "MH_Longitude", "MHLTH_Adj95CI"],
+    gs_drop_cols=["Country"],
+    on=["PlaceName", "State"],
+):
     """
-    Output the dataframe to a csv file if the file does not exist
+    Rename and drop the unnecessary columns of the cleaned mental health and greenspace dataframes,
+    Return the inner join of both dataframes on the city and state columns
     """
-    if os.path.exists(file_path):
+    mh = mh_df.rename(columns=mh_rename_cols).drop(columns=mh_drop_cols)
+    gs = gs_df.drop(columns=gs_drop_cols)
+    return pd.merge(mh, gs, on=on, how="inner")
+
+
+def aggregate_uc(
+    df,
+    group_col="UC Grouping",
+    rules=UC_AGG_RULES,
+    default_rule="mean",
+    drop_cols=["PlaceName"],
+    out_group_col="UC_Grouping",
+):
+    """
+    Re-aggregate the merged city-level dataframe back to the urban center level in one grouped reduction.
+    Return the urban center level dataframe with group_col renamed to out_group_col.
+
+    Parameters:
+        df: dataframe, the merged city-level data
+        group_col: str, the urban center key column
+        rules: dict of column to "sum", "mean", "first" or ("weighted_mean", weight column),
+            the columns not in rules are aggregated with default_rule
+        default_rule: str, the rule of the columns not in rules
+        drop_cols: list, the columns left out of the result
+        out_group_col: str, the name of the urban center key column in the result
+    """
+    cols = [col for col in df.columns if col not in drop_cols + [group_col]]
+    col_rules = {col: rules.get(col, default_rule) for col in cols}
+
+    # derived columns: object columns holding numbers, as they can't be summed or averaged,
+    # and the weighted values and weights of the weighted means
+    weighted = {col: rule[1] for col, rule in col_rules.items() if isinstance(rule, tuple)}
+    derived = {
+        col: pd.to_numeric(df[col])
+        for col, rule in col_rules.items()
+        if rule != "first" and df[col].dtype == object
+    }
+    for col, weight_col in weighted.items():
+        # the sum of the weighted values over the sum of the weights of the non-missing values
+        value = derived.get(col, df[col])
+        weight = derived.get(weight_col, df[weight_col]).astype(float)
+        derived[f"{col}__wx"] = value * weight
+        derived[f"{col}__w"] = weight.where(value.notna())
+    rule_cols = {"sum": [f"{col}__{part}" for col in weighted for part in ("wx", "w")]}
+    for col, rule in col_rules.items():
+        if col not in weighted:
+            rule_cols.setdefault(rule, []).append(col)
+
+    # the group keys are computed once, and every rule reduces its block of columns in one call,
+    # reading the columns in place instead of copying the whole dataframe first
+    groups = df.groupby(group_col, sort=True)
+    derived_groups = pd.DataFrame(derived).groupby(df[group_col], sort=True)
+    grouped = []
+    for rule, block in rule_cols.items():
+        in_place = [col for col in block if col not in derived]
+        if in_place:
+            grouped.append(groups[in_place].agg(rule))
+        if len(in_place) < len(block):
+            grouped.append(derived_groups[[col for col in block if col in derived]].agg(rule))
+    grouped = pd.concat(grouped, axis=1)
+    for col in weighted:
+        grouped[col] = grouped.pop(f"{col}__wx") / grouped.pop(f"{col}__w")
+
+    # the key and the aggregated columns keep their order, followed by the first-value columns
+    first_cols = [col for col in list(rules) + cols if col in cols and col_rules[col] == "first"]
+    first_cols = list(dict.fromkeys(first_cols))
+    out_cols = [col for col in df.columns if col == group_col or col in cols and col not in first_cols]
+    dfagg = grouped.reset_index()[out_cols + first_cols]
+    return dfagg.rename(columns={group_col: out_group_col})
+
+
+def save_csv(df, file_path, index=False, overwrite=False, categorical_cols=None):
+    """
+    Output the dataframe to a csv file if the file does not exist,
+    or replace it when overwrite is True.
+
+    A .parquet, .feather or .arrow file path writes the columnar format instead,
+    geodataframes are written as GeoParquet, and categorical_cols are stored as categoricals.
+    """
+    if os.path.exists(file_path) and not overwrite:
         print(f"{file_path} already exists.")
-    else:
-        return df.to_csv(file_path, index=False)
+        return None
+
+    fmt = file_format(file_path)
+    if fmt == "csv":
+        return df.to_csv(file_path, index=index)
+
+    outdf = df
+    if categorical_cols:
+        outdf = outdf.astype({col: "category" for col in categorical_cols})
+    if fmt == "parquet":
+        return outdf.to_parquet(file_path, index=index)
+    # feather can't store an index, so it is kept as a column when index is True
+    return outdf.reset_index(drop=not index).to_feather(file_path)
+
 
 def show_top5(df, col_name):
     """
@@ -54,9 +537,10 @@ def show_top5(df, col_name):
     """
     return df.sort_values(by=col_name, ascending=False).head(5)
 
+
 def mh_plotly_treemap(
     df,
-    path_lst=[px.Constant("US"), "StateAbbr", "PlaceName"],
+    path_lst=None,
     color="MHLTH_AdjPrev",
     values="MHLTH_AdjPrev",
     style="Blues",
@@ -69,7 +553,8 @@ def mh_plotly_treemap(
 
     Parameters:
         df: dataframe
-        path_lst: list, the path of the treemap to have a constant parent node, use px.Constant()
+        path_lst: list, the path of the treemap to have a constant parent node, use px.Constant(),
+            [px.Constant("US"), "StateAbbr", "PlaceName"] if None
         color: str, the column name for color
         values(str), the column name for values
         style: str, the color style
@@ -77,6 +562,10 @@ def mh_plotly_treemap(
         width: int, the width of the treemap
         height: int, the height of the treemap
     """
+    import plotly.express as px
+
+    if path_lst is None:
+        path_lst = [px.Constant("US"), "StateAbbr", "PlaceName"]
     fig = px.treemap(
         df,
         path=path_lst,
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import cdist
+
+import file_path as fp
+import similarity_module as sm
+
+### All-pairs distances between the urban centers over a feature set, for clustering and "peer city" tables.
+### The distances are computed block by block of rows (with BLAS matrix products for the euclidean metric),
+### so memory stays bounded by block_size * n besides the condensed matrix itself,
+### and the condensed matrix is cached on disk, keyed by the features, their scaling, weights, metric and values.
+
+## example usage of distance_matrix
+# dist, labels = dm.distance_matrix(df, sm.SIGNICOLS)
+# peers = dm.top_k(dist, labels, k=5)
+# labels["Cluster"] = dm.cluster(dist, n_clusters=8)
+
+SCALINGS = ["zscore", "minmax", None]
+
+
+def scale_features(x, scaling="zscore"):
+    """
+    Scale the columns of the 2d feature array: zscore (like StandardScaler), minmax to [0, 1], or None
+    """
+    if scaling == "zscore":
+        return sm.standardize(x)[0]
+    if scaling == "minmax":
+        min_value = x.min(axis=0)
+        value_range = x.max(axis=0) - min_value
+        value_range[value_range == 0] = 1
+        return (x - min_value) / value_range
+    if scaling is None:
+        return x
+    raise ValueError(f"scaling must be one of {SCALINGS}, got {scaling}")
+
+
+def feature_matrix(
+    df, features=sm.SIGNICOLS, scaling="zscore", weights=None, metric="euclidean", label_cols=["Urban Center"]
+):
+    """
+    Return the scaled and weighted feature array of the urban centers without missing features,
+    and the dataframe of their label_cols in the same order
+    """
+    x = df[list(features)].to_numpy(dtype=float)
+    complete = ~np.isnan(x).any(axis=1)
+    x = scale_features(x[complete], scaling) * sm.weight_scale(features, weights, metric)
+    labels = df.loc[complete, [col for col in label_cols if col in df.columns]].reset_index(drop=True)
+    return np.ascontiguousarray(x), labels
+
+
+def pairwise_block(a, b, metric="euclidean"):
+    """
+    Return the (len(a), len(b)) distances between the rows of a and b
+    """
+    if metric == "euclidean":
+        # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, one matrix product for the whole block
+        sq = (a * a).sum(axis=1)[:, np.newaxis] + (b * b).sum(axis=1) - 2 * a @ b.T
+        return np.sqrt(np.maximum(sq, 0, out=sq), out=sq)
+    return cdist(a, b, metric={"manhattan": "cityblock"}.get(metric, metric))
+
+
+def condensed_index(n, i, j):
+    """
+    Return the position of the pair (i, j), i < j, in the condensed distance matrix of n items
+    """
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def condensed_distances(x, metric="euclidean", block_size=1024, dtype=np.float64):
+    """
+    Compute the condensed distance matrix of the rows of x, like scipy pdist, block_size rows at a time
+    """
+    n = len(x)
+    condensed = np.empty(n * (n - 1) // 2, dtype=dtype)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        # only the upper triangle: rows start:stop against the columns start:n
+        block = pairwise_block(x[start:stop], x[start:], metric)
+        for i in range(start, stop):
+            begin = condensed_index(n, i, i + 1)
+            condensed[begin : begin + n - i - 1] = block[i - start, i - start + 1 :]
+    return condensed
+
+
+def cache_key(x, features, scaling, weights, metric, dtype):
+    """
+    Return the cache key of the distance matrix of the feature array x
+    """
+    params = json.dumps(
+        [list(features), scaling, weights, metric, np.dtype(dtype).name], sort_keys=True, default=str
+    )
+    digest = hashlib.sha256(params.encode())
+    digest.update(np.ascontiguousarray(x).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def distance_matrix(
+    df,
+    features=sm.SIGNICOLS,
+    scaling="zscore",
+    weights=None,
+    metric="euclidean",
+    label_cols=["UC_Grouping", "Urban Center", "State"],
+    block_size=1024,
+    dtype=np.float64,
+    cache_dir=fp.distance_cache_dir,
+):
+    """
+    Return the condensed all-pairs distance matrix of the urban centers and the dataframe of their labels.
+
+    Parameters:
+        df: dataframe, one row per urban center
+        features: list, the feature columns, SIGNICOLS by default
+        scaling: str, zscore, minmax or None
+        weights: dict of feature to weight or list of weights, equal weights if None
+        metric: str, euclidean, manhattan or chebyshev
+        label_cols: list, the columns kept in the labels dataframe when present in df
+        block_size: int, the number of rows computed at a time
+        dtype: the dtype of the matrix, float32 halves the memory of large matrices
+        cache_dir: str, the cache directory, None to not cache
+    The cached matrix is memory-mapped read-only, urban centers with a missing feature are left out.
+    """
+    x, labels = feature_matrix(df, features, scaling, weights, metric, label_cols)
+    if cache_dir is None:
+        return condensed_distances(x, metric, block_size, dtype), labels
+
+    cache_file = os.path.join(
+        cache_dir, f"dist_{cache_key(x, features, scaling, weights, metric, dtype)}.npy"
+    )
+    if not os.path.exists(cache_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        condensed = condensed_distances(x, metric, block_size, dtype)
+        with open(cache_file + ".tmp", "wb") as f:
+            np.save(f, condensed)
+        os.replace(cache_file + ".tmp", cache_file)
+    return np.load(cache_file, mmap_mode="r"), labels
+
+
+def item_count(condensed):
+    """
+    Return the number of items of a condensed distance matrix
+    """
+    return int(round((1 + np.sqrt(1 + 8 * len(condensed))) / 2))
+
+
+def distance_rows(condensed, rows):
+    """
+    Return the (len(rows), n) square distance matrix rows gathered from the condensed matrix,
+    with the distance of every item to itself set to inf
+    """
+    n = item_count(condensed)
+    i = np.asarray(rows)[:, np.newaxis]
+    j = np.arange(n)
+    low, high = np.minimum(i, j), np.maximum(i, j)
+    diagonal = low == high
+    positions = condensed_index(n, low, high)
+    positions[diagonal] = 0
+    square = np.asarray(condensed[positions], dtype=float)
+    square[diagonal] = np.inf
+    return square
+
+
+def top_k(condensed, labels, k=5, block_size=1024):
+    """
+    Find the k nearest urban centers of every urban center, block_size rows at a time,
+    Return the long "peer city" dataframe: the labels of the urban center, the rank, the labels of the peer and the distance
+    """
+    n = item_count(condensed)
+    k = min(k, n - 1)
+    neighbors = np.empty((n, k), dtype=np.intp)
+    distances = np.empty((n, k))
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        square = distance_rows(condensed, rows)
+        nearest = np.argpartition(square, k - 1, axis=1)[:, :k]
+        nearest_dist = np.take_along_axis(square, nearest, axis=1)
+        order = np.argsort(nearest_dist, axis=1, kind="stable")
+        neighbors[rows] = np.take_along_axis(nearest, order, axis=1)
+        distances[rows] = np.take_along_axis(nearest_dist, order, axis=1)
+
+    peers = labels.iloc[np.repeat(np.arange(n), k)].reset_index(drop=True)
+    peers["Rank"] = np.tile(np.arange(1, k + 1), n)
+    similar = labels.iloc[neighbors.ravel()].reset_index(drop=True).add_prefix("Similar ")
+    peers = pd.concat([peers, similar], axis=1)
+    peers["Distance"] = distances.ravel()
+    return peers
+
+
+def cluster(condensed, method="average", n_clusters=None, distance_threshold=None):
+    """
+    Cluster the urban centers hierarchically on the condensed distance matrix.
+
+    Parameters:
+        condensed: array, the condensed distance matrix
+        method: str, the scipy linkage method: single, complete, average, weighted or ward (euclidean only)
+        n_clusters: int, cut the tree into at most n_clusters clusters
+        distance_threshold: float, or cut the tree at this distance
+    Return the cluster label of every urban center, numbered from 1,
+    or the scipy linkage matrix when neither n_clusters nor distance_threshold is given.
+    """
+    linkage = hierarchy.linkage(np.asarray(condensed, dtype=float), method=method)
+    if n_clusters is not None:
+        return hierarchy.fcluster(linkage, n_clusters, criterion="maxclust")
+    if distance_threshold is not None:
+        return hierarchy.fcluster(linkage, distance_threshold, criterion="distance")
+    return linkage
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+### Typed feature arrays for the map functions.
+### The feature columns are pulled once into a (rows, features) float64 array, with every feature contiguous in memory,
+### normalized in place with one broadcast operation over all features (min-max, z-score or rank),
+### and set on a new frame that shares the other columns with the input instead of copying the whole dataframe.
+
+## example usage of normalize, then put the normalized columns back
+# values = feature_array(df, ["Avg Greenness", "MH_Score"])
+# normalize(values, "minmax", out=values)
+# normalized_df = with_columns(df, {"Avg Greenness": values[:, 0], "MH_Score": values[:, 1]})
+
+
+def feature_array(df, features, out=None):
+    """
+    Return the (rows, features) float64 array of the feature columns, stored column by column,
+    pass out to fill an existing array instead of allocating one
+    """
+    if out is None:
+        out = np.empty((len(df), len(features)), dtype=np.float64, order="F")
+    for j, feature in enumerate(features):
+        out[:, j] = df[feature].to_numpy(dtype=np.float64, na_value=np.nan)
+    return out
+
+
+def minmax(x, out=None):
+    """
+    Scale every column of x to [0, 1], constant columns become NaN like (x - min) / (max - min)
+    """
+    min_value = np.nanmin(x, axis=0)
+    value_range = np.nanmax(x, axis=0) - min_value
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.subtract(x, min_value, out=out)
+        return np.divide(out, value_range, out=out)
+
+
+def zscore(x, out=None, ddof=0):
+    """
+    Standardize every column of x to zero mean and unit variance, like sklearn StandardScaler
+    """
+    mean = np.nanmean(x, axis=0)
+    scale = np.nanstd(x, axis=0, ddof=ddof)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.subtract(x, mean, out=out)
+        return np.divide(out, scale, out=out)
+
+
+def rank(x, out=None):
+    """
+    Replace every value of x by its percentile rank in its column, ties get their average rank,
+    like DataFrame.rank(pct=True)
+    """
+    from scipy.stats import rankdata
+
+    ranks = rankdata(x, axis=0, nan_policy="omit")
+    counts = np.sum(~np.isnan(x), axis=0)
+    return np.divide(ranks, counts, out=out)
+
+
+NORMALIZERS = {"minmax": minmax, "zscore": zscore, "rank": rank}
+
+
+def normalize(x, method="minmax", out=None):
+    """
+    Normalize every column of the 2d array x with method, minmax, zscore or rank,
+    pass out=x to normalize in place
+    """
+    if method not in NORMALIZERS:
+        raise ValueError(f"method must be one of {list(NORMALIZERS)}, got {method}")
+    return NORMALIZERS[method](x, out=out)
+
+
+def with_columns(df, columns):
+    """
+    Return a new dataframe of the same type as df with the columns set, or added, from the dictionary of arrays.
+    The arrays and the other columns of df are not copied, so the result shares memory with df and the arrays.
+    """
+    data = {col: df[col] for col in df.columns}
+    data.update(columns)
+    if hasattr(df, "geometry"):
+        new_df = type(df)(data, index=df.index, geometry=df.geometry.name, crs=df.crs, copy=False)
+    else:
+        new_df = pd.DataFrame(data, index=df.index, copy=False)
+    new_df.attrs = dict(df.attrs)
+    return new_df
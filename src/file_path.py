@@ -2,4 +2,20 @@ mh_file = '../data/raw_data/500_Cities__City-level_Data__GIS_Friendly_Format___2
 mh_cleaned = '../data/cleaned_data/mh_cleaned.csv'
 geo_us_file = '../data/geo_data_cleaned/Greenspace_US.geojson'
 merged_data_file = '../data/cleaned_data/merged_cleaned_data.csv'
-state_geo_file = '../data/geo_data_cleaned/state_gdf.geojson'
\ No newline at end of file
+state_geo_file = '../data/geo_data_cleaned/state_gdf.geojson'
+state_boundaries_file = '../data/raw_data/cb_2018_us_state_500k/cb_2018_us_state_500k.shp'
+# the full GHS UCDB files are downloaded separately, see clean_merge_module.GS_DOWNLOAD_URL
+gs_raw_file = '../data/raw_data/GreenspaceDownload/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2.csv'
+gs_raw_gpkg = '../data/raw_data/GreenspaceDownload/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2.gpkg'
+gs_cleaned = '../data/cleaned_data/greenspace_cleaned.csv'
+pipeline_cache_dir = '../data/.pipeline_cache'
+merged_data_parquet = '../data/cleaned_data/merged_cleaned_data.parquet'
+geo_us_asset = '../data/geo_data_cleaned/Greenspace_US.parquet'
+state_geo_asset = '../data/geo_data_cleaned/state_gdf.parquet'
+division_geo_asset = '../data/geo_data_cleaned/division_gdf.parquet'
+region_geo_asset = '../data/geo_data_cleaned/region_gdf.parquet'
+tile_cache_dir = '../data/tile_cache'
+tile_export_dir = '../data/tiles'
+similarity_index_file = '../data/cleaned_data/similarity_index.pkl'
+distance_cache_dir = '../data/.distance_cache'
+render_cache_dir = '../data/.render_cache'
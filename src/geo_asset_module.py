@@ -0,0 +1,184 @@
+import json
+import os
+
+import shapely
+
+import clean_merge_module as cm
+import file_path as fp
+
+### Geo assets are stored as GeoParquet: a columnar file with the geometries encoded as WKB.
+### The file is memory-mapped when read and the WKB geometries are only decoded when needed,
+### so map rendering does not pay for parsing the geojson text on every call.
+
+## example usage of build_geo_assets, from the src directory
+# python geo_asset_module.py
+
+### Geo assets also hold simplified copies of the geometries at several levels of detail (LOD),
+### stored as extra WKB columns named by LOD_TOLERANCES, the simplification tolerance in the units of the crs.
+### The maps pick the coarsest LOD whose tolerance is below the size of a pixel.
+
+LOD_TOLERANCES = {"geometry_lod1": 0.002, "geometry_lod2": 0.01, "geometry_lod3": 0.05}
+
+
+def simplify_geometries(geometry, tolerance):
+    """
+    Simplify the geometries without changing their topology.
+    With shapely >= 2.1 the geometries are simplified as a coverage, so shared borders stay shared,
+    otherwise every geometry is simplified on its own with preserve_topology.
+    """
+    import geopandas as gpd
+
+    if hasattr(shapely, "coverage_simplify"):
+        simplified = shapely.coverage_simplify(geometry.to_numpy(), tolerance)
+        return gpd.GeoSeries(simplified, index=geometry.index, crs=geometry.crs)
+    return geometry.simplify(tolerance, preserve_topology=True)
+
+
+def add_lod_columns(gdf, tolerances=LOD_TOLERANCES):
+    """
+    Return a copy of the geodataframe with a simplified geometry column per level of detail in tolerances
+    """
+    lod_gdf = gdf.copy()
+    for col, tolerance in tolerances.items():
+        lod_gdf[col] = simplify_geometries(gdf.geometry, tolerance)
+    return lod_gdf
+
+
+def dissolve_levels(state_gdf, state_col="STUSPS", levels=None):
+    """
+    Dissolve the state polygons into the division and region shapes.
+    Return a dictionary of level name to geodataframe, with the level name as key column.
+    """
+    levels = levels or {"Division": cm.us_division(), "Region": cm.us_region()}
+    shapes = {}
+    for level, label_dict in levels.items():
+        state_label = {state: label for label, states in label_dict.items() for state in states}
+        gdf = state_gdf[[state_col, state_gdf.geometry.name]].copy()
+        gdf[level] = gdf[state_col].map(state_label)
+        shapes[level] = gdf.dropna(subset=[level]).dissolve(by=level).reset_index()[[level, "geometry"]]
+    return shapes
+
+
+def to_geo_asset(gdf, file_path, overwrite=False, tolerances=None):
+    """
+    Write the geodataframe as a GeoParquet geo asset if the file does not exist,
+    or replace it when overwrite is True.
+    Pass tolerances, like LOD_TOLERANCES, to also store the simplified levels of detail.
+    """
+    if os.path.exists(file_path) and not overwrite:
+        print(f"{file_path} already exists.")
+    else:
+        if tolerances:
+            gdf = add_lod_columns(gdf, tolerances)
+        gdf.to_parquet(file_path, index=False)
+    return None
+
+
+def geojson_to_geo_asset(geojson_path, file_path, overwrite=False, tolerances=None):
+    """
+    Convert a geojson file to a GeoParquet geo asset
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(geojson_path)
+    to_geo_asset(gdf, file_path, overwrite=overwrite, tolerances=tolerances)
+    return gdf
+
+
+def shapefile_to_geo_asset(
+    shp_path, file_path, cols=["STUSPS", "NAME", "geometry"], overwrite=False, tolerances=None
+):
+    """
+    Convert a shapefile to a GeoParquet geo asset keeping only the columns in cols,
+    rows with missing values are dropped like the state_gdf.geojson file
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(shp_path)[cols]
+    gdf = gdf.dropna(how="any")
+    to_geo_asset(gdf, file_path, overwrite=overwrite, tolerances=tolerances)
+    return gdf
+
+
+def geo_asset_crs(file_path, geometry_col="geometry"):
+    """
+    Return the crs stored in the GeoParquet metadata of the geo asset, None if not set
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(file_path, memory_map=True).metadata or {}
+    geo = json.loads(metadata.get(b"geo", b"{}"))
+    return geo.get("columns", {}).get(geometry_col, {}).get("crs")
+
+
+def read_geo_asset(file_path, columns=None, geometry_col="geometry", decode=True):
+    """
+    Memory-map the geo asset and return its rows.
+
+    Parameters:
+        file_path: str, the GeoParquet geo asset
+        columns: list, the attribute columns to read, all columns if None
+        geometry_col: str, the geometry column name
+        decode: bool, decode the WKB geometries into a geodataframe,
+            otherwise return a dataframe with the raw WKB bytes to decode later with decode_geo_asset
+    """
+    import pyarrow.parquet as pq
+
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + [geometry_col]))
+    table = pq.read_table(file_path, columns=columns, memory_map=True)
+    df = table.to_pandas()
+    df.attrs["crs"] = geo_asset_crs(file_path, geometry_col)
+    if decode:
+        return decode_geo_asset(df, geometry_col)
+    return df
+
+
+def decode_geo_asset(df, geometry_col="geometry", crs=None):
+    """
+    Decode the WKB geometry column of a dataframe read with read_geo_asset(decode=False),
+    Return the geodataframe
+    """
+    import geopandas as gpd
+
+    crs = crs if crs is not None else df.attrs.get("crs")
+    gdf = df.copy()
+    # rows left unmatched by a merge hold NaN instead of WKB bytes
+    wkb = df[geometry_col].astype(object).where(df[geometry_col].notna(), None)
+    gdf[geometry_col] = gpd.GeoSeries.from_wkb(wkb, index=df.index, crs=crs)
+    return gpd.GeoDataFrame(gdf, geometry=geometry_col, crs=crs)
+
+
+def build_geo_assets(
+    geo_us_file=fp.geo_us_file,
+    geo_us_asset=fp.geo_us_asset,
+    state_shp_file=fp.state_boundaries_file,
+    state_asset=fp.state_geo_asset,
+    division_asset=fp.division_geo_asset,
+    region_asset=fp.region_geo_asset,
+    tolerances=LOD_TOLERANCES,
+    overwrite=True,
+):
+    """
+    Build the GeoParquet geo assets, with their simplified levels of detail, from the Greenspace_US geojson
+    and the cb_2018_us_state_500k shapefile, and the division and region shapes dissolved from the states
+    """
+    geojson_to_geo_asset(geo_us_file, geo_us_asset, overwrite=overwrite, tolerances=tolerances)
+    print(f"{geo_us_asset} built.")
+    if not os.path.exists(state_shp_file):
+        print(f"{state_shp_file} not found, skipping the state, division and region geo assets.")
+        return None
+
+    state_gdf = shapefile_to_geo_asset(
+        state_shp_file, state_asset, overwrite=overwrite, tolerances=tolerances
+    )
+    print(f"{state_asset} built.")
+    shapes = dissolve_levels(state_gdf)
+    for level, file_path in [("Division", division_asset), ("Region", region_asset)]:
+        to_geo_asset(shapes[level], file_path, overwrite=overwrite, tolerances=tolerances)
+        print(f"{file_path} built.")
+    return None
+
+
+if __name__ == "__main__":
+    build_geo_assets()
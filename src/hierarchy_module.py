@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import clean_merge_module as cm
+
+### Hierarchical aggregation of the urban center data: urban center -> state -> division / region.
+### The membership of every urban center in every level is precomputed once as a sparse 0/1 matrix,
+### so a rollup of any number of features to any level is a single sparse matrix product,
+### optionally weighted by population, and the geometries are joined to the result by key afterwards.
+
+## example usage of rollup
+# hierarchy = build_hierarchy(normalized_df["State"])
+# state_df = rollup(normalized_df[["MH_Score", "Avg Greenness"]], hierarchy, "State", weights=normalized_df["Population"])
+# state_gdf = join_geometry(state_df, normalized_df, "State")
+
+LEVELS = ["State", "Division", "Region"]
+
+
+def membership_matrix(keys, labels=None):
+    """
+    Return the sparse (groups, items) 0/1 matrix of the group each item belongs to and the group labels.
+    Items whose key is missing or not in labels belong to no group.
+    """
+    keys = pd.Series(keys).reset_index(drop=True)
+    if labels is None:
+        labels = pd.Index(keys.dropna().unique()).sort_values()
+    codes = pd.Index(labels).get_indexer(keys)
+    items = np.flatnonzero(codes >= 0)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(items)), (codes[items], items)), shape=(len(labels), len(keys))
+    )
+    return matrix, pd.Index(labels)
+
+
+def label_keys(label_dict):
+    """
+    Invert a {label: [state, ...]} dictionary like us_division into a state to label series
+    """
+    return pd.Series({state: label for label, states in label_dict.items() for state in states})
+
+
+def build_hierarchy(states, divisions=None, regions=None):
+    """
+    Precompute the sparse membership matrices of the urban centers in every level.
+
+    Parameters:
+        states: array, the state of every urban center
+        divisions: dict of division to states, us_division by default
+        regions: dict of region to states, us_region by default
+    Return a dictionary of level to (urban center membership matrix, level labels).
+    """
+    divisions = cm.us_division() if divisions is None else divisions
+    regions = cm.us_region() if regions is None else regions
+
+    state_matrix, state_labels = membership_matrix(states)
+    hierarchy = {"State": (state_matrix, state_labels)}
+    for level, label_dict in [("Division", divisions), ("Region", regions)]:
+        parent = label_keys(label_dict).reindex(state_labels)
+        # urban center -> level is the product of urban center -> state and state -> level
+        parent_matrix, labels = membership_matrix(
+            parent.to_numpy(), labels=pd.Index(list(label_dict))
+        )
+        hierarchy[level] = ((parent_matrix @ state_matrix).tocsr(), labels)
+    return hierarchy
+
+
+def rollup(values, hierarchy, level="State", weights=None):
+    """
+    Average the urban center values at the level in one sparse matrix product.
+
+    Parameters:
+        values: dataframe or 2d array, one row per urban center and one column per feature
+        hierarchy: dict, the output of build_hierarchy
+        level: str, State, Division or Region
+        weights: array, the weight of every urban center like its population, equal weights if None
+    Return the dataframe of the level means, indexed by the level labels,
+    NaN values are left out of the means like DataFrame.mean, and so are the urban centers with a NaN weight.
+    """
+    matrix, labels = hierarchy[level]
+    columns = values.columns if isinstance(values, pd.DataFrame) else None
+    x = np.asarray(values, dtype=float)
+    x = x.reshape(len(x), -1)
+    w = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=float)
+    # a missing weight counts as zero, instead of turning the whole group NaN
+    w = np.where(np.isnan(w), 0, w)
+
+    valid = ~np.isnan(x)
+    weighted_x = np.where(valid, x, 0) * w[:, np.newaxis]
+    weight_sum = matrix @ (valid * w[:, np.newaxis])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (matrix @ weighted_x) / weight_sum
+    return pd.DataFrame(means, index=labels.rename(level), columns=columns)
+
+
+def join_geometry(level_df, geo_df, key, geometry_col="geometry", extra_cols=[]):
+    """
+    Join the first geometry of every key of geo_df, and its extra_cols like the levels of detail, to the level dataframe,
+    Return the geodataframe with the key as a column, levels without a geometry are dropped
+    """
+    import geopandas as gpd
+
+    shapes = geo_df[geo_df[geometry_col].notna()].drop_duplicates(key).set_index(key)
+    level_df = level_df[level_df.index.isin(shapes.index)]
+    gdf = gpd.GeoDataFrame(
+        level_df.reset_index(),
+        geometry=shapes[geometry_col].reindex(level_df.index).values,
+        crs=geo_df.crs,
+    )
+    for col in extra_cols:
+        gdf[col] = shapes[col].reindex(level_df.index).values
+    return gdf
@@ -1,15 +1,21 @@
-from generativepy.color import Color
-import matplotlib.pyplot as plt
-from PIL import ImageColor
-import contextily as cx
-import geopandas as gpd
 import pandas as pd
 import numpy as np
-
-
-import warnings
-
-warnings.filterwarnings("ignore")
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import re
+
+import binning_module as bn
+import clean_merge_module as cm
+import feature_array_module as fa
+import geo_asset_module as ga
+import palette_module as pl
+import spatial_index_module as si
+import tile_module as tm
+
+### matplotlib.pyplot, geopandas and contextily are imported inside the functions drawing or reading the maps,
+### and hierarchy_module (scipy.sparse) inside the functions rolling up the states,
+### so worker processes and scripts that only use the data functions don't pay for loading them.
 
 ### Below one_function_bimap_state_level is a consolidated function that combines all functions to plot a state_level bivariate choropleth map
 ### Note there is no subplot option for this function, as it is designed to plot a single map
@@ -37,12 +43,14 @@ def one_function_bimap_state_level(
     x_label="Mental Illness Score Index",
     y_label="Average Greenness Index",
     title_fontsize=10,
+    weight_col=None,
 ):
     """
     Consolidate functions return the normalized geodataframe with key features and colorlist for bivariate choropleth map.
+    The state values are the means of the urban centers, weighted by weight_col (like "Population") if given.
 
     Consolidated functions:
-        - merge_geo_df
+        - cached_merge_geo_df
         - df_focused_env_feature
         - normalize_features
         - mikhailsirenko_colorscale
@@ -52,13 +60,30 @@ def one_function_bimap_state_level(
         - set_off_axis
         - bicolor_legend
     """
-    geo_df = merge_geo_df(geo_path, merged_path, lefton, righton)
-    focused_df = df_focused_env_feature(geo_df, env_feature, other_features)
+    import hierarchy_module as hr
+
+    geo_df = cached_merge_geo_df(
+        geo_path,
+        merged_path,
+        lefton,
+        righton,
+        columns=[mh_feature, env_feature] + other_features + ([weight_col] if weight_col else []),
+    )
+    weight_features = [weight_col] if weight_col and weight_col not in other_features else []
+    focused_df = df_focused_env_feature(geo_df, env_feature, other_features + weight_features)
     normalized_df = normalize_features(focused_df, env_feature, mh_feature=mh_feature)
 
     colorlist = mikhailsirenko_colorscale(percentile, color_list)
-    state_df = normalized_df.groupby(["State", "geometry"]).mean().reset_index()
-    state_df = gpd.GeoDataFrame(state_df, geometry="geometry")
+    # roll the urban centers up to the states by key and join the state geometries back
+    value_cols = [
+        col
+        for col in normalized_df.select_dtypes("number").columns
+        if col not in ["State"] + weight_features
+    ]
+    weights = normalized_df[weight_col] if weight_col else None
+    hierarchy = hr.build_hierarchy(normalized_df["State"])
+    state_df = hr.rollup(normalized_df[value_cols], hierarchy, "State", weights=weights)
+    state_df = hr.join_geometry(state_df, normalized_df, "State", extra_cols=lod_cols(normalized_df))
     state_color_df = assign_color_cells(
         state_df,
         env_feature,
@@ -102,40 +127,365 @@ def one_function_bimap_state_level(
     return None
 
 
-def merge_geo_df(geo_path, merged_path_or_df, lefton, righton):
+### Below batch_bimap_state_level renders the state-level bivariate map of many environmental features at once.
+### The geo merge, the normalization and the state groupby are done once for all features,
+### and every feature re-colors the same state polygons, basemap and legend before saving its image.
+
+## example usage of batch_bimap_state_level
+# map.batch_bimap_state_level(state_data, merged_data, ['Avg Greenness', 'Avg Precipitation'], out_dir='../maps')
+
+
+def state_level_classes(
+    geo_df,
+    env_features,
+    mh_feature="MH_Score",
+    state_col="State",
+    percentile=np.linspace(0.33, 1, 3),
+    weight_col=None,
+    level="State",
+):
+    """
+    Normalize the mental health feature and all env_features in one pass and average them by state,
+    or by the Division or Region level of the states, weighted by weight_col if given,
+    Return the level geodataframe, the (level, feature) env color class array and the level mental health color classes.
+    The level geometries are joined from geo_df by state_col, or by the level column for the Division and Region levels.
+    """
+    import hierarchy_module as hr
+
+    cols = list(dict.fromkeys(list(env_features) + [mh_feature]))
+    values = fa.normalize(fa.feature_array(geo_df, cols), "minmax")
+    normalized = pd.DataFrame(values, columns=cols, index=geo_df.index, copy=False)
+
+    # roll up on the state key and join the state geometries back by key, instead of grouping on geometries
+    has_geometry = geo_df.geometry.notna().to_numpy()
+    weights = geo_df[weight_col][has_geometry] if weight_col else None
+    hierarchy = hr.build_hierarchy(geo_df[state_col][has_geometry])
+    state_mean = hr.rollup(normalized[has_geometry], hierarchy, level, weights=weights)
+    key_col = state_col if level == "State" else level
+    state_mean.index.name = key_col
+    # the divisions and regions without a shape are left out, so the classes line up with the shapes
+    state_mean = state_mean[state_mean.index.isin(geo_df[key_col][has_geometry])]
+    state_df = hr.join_geometry(state_mean, geo_df, key_col, extra_cols=lod_cols(geo_df))
+
+    env_classes = bn.classify(state_mean[list(env_features)].to_numpy(), percentile, reverse=True)
+    mh_classes = bn.classify(state_mean[mh_feature].to_numpy(), percentile, reverse=True)
+    return state_df, env_classes, mh_classes
+
+
+def class_colors(colorlist, env_classes, mh_classes):
+    """
+    Look up the RGBA color of every (env class, mental health class) pair in the bivariate colorlist,
+    cells with a -1 class are transparent
+    """
+    mh_classes = np.broadcast_to(mh_classes.reshape(-1, *([1] * (env_classes.ndim - 1))), env_classes.shape)
+    rgba = np.ones(env_classes.shape + (4,))
+    rgba[..., :3] = colorlist[env_classes, mh_classes]
+    rgba[(env_classes < 0) | (mh_classes < 0)] = 0
+    return rgba
+
+
+def patch_index(gdf):
+    """
+    Return the row of every patch geopandas draws for gdf, as multi-polygons are drawn as one patch per part
+    """
+    import shapely
+
+    return np.repeat(np.arange(len(gdf)), shapely.get_num_geometries(gdf.geometry.to_numpy()))
+
+
+def feature_file_name(feature, prefix="bimap", file_format="png"):
+    """
+    Return a file name for the map of the feature, e.g. bimap_avg_greenness.png
+    """
+    slug = re.sub(r"[^0-9a-zA-Z]+", "_", feature.replace("%", "pct")).strip("_").lower()
+    return f"{prefix}_{slug}.{file_format}"
+
+
+def render_bimap_features(
+    state_df,
+    env_features,
+    colors,
+    colorlist,
+    out_paths,
+    percentile=np.linspace(0.33, 1, 3),
+    legend_position=[0, 0.1, 0.1, 0.1],
+    tick_fontsize=5,
+    label_fontsize=5,
+    x_label="Mental Illness Score Index",
+    y_labels=None,
+    title_fontsize=10,
+    fig_size=(14, 20),
+    dpi=150,
+    basemap=True,
+):
+    """
+    Draw the state polygons, basemap and legend once, then re-color the polygons and save one image per feature.
+    colors is the (state, feature, RGBA) array from class_colors.
+    Return the list of saved file paths.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = mat_subplots(1, 1, fig_size=fig_size)
+    ax.set_xlim(-125, -66.7)
+    ax.set_ylim(25, 50)
+    state_df = with_lod(state_df, lod_column(state_df, ax, dpi=dpi))
+    state_df.plot(
+        ax=ax, legend=False, color=colors[:, 0, :3], alpha=1, edgecolor="black", linewidth=0.35
+    )
+    states = ax.collections[-1]
+    patches = patch_index(state_df)
+    if basemap:
+        add_basemap(ax, crs=state_df.crs)
+    bicolor_legend(
+        ax,
+        colorlist,
+        percentile=percentile,
+        legend_position=legend_position,
+        tick_fontsize=tick_fontsize,
+        label_fontsize=label_fontsize,
+        x_label=x_label,
+        y_label="",
+    )
+    legend_ax = ax.child_axes[-1]
+    set_off_axis(ax)
+    title = ax.set_title(label="", fontsize=title_fontsize)
+
+    for k, feature in enumerate(env_features):
+        states.set_facecolor(colors[patches, k])
+        legend_ax.set_ylabel(
+            y_labels[k] if y_labels else f"{feature} (Normalized)", fontsize=label_fontsize
+        )
+        title.set_text(f"Normalized Mental Illness Score and {feature} Score by State")
+        fig.savefig(out_paths[k], dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    return list(out_paths)
+
+
+def batch_bimap_state_level(
+    geo_path,
+    merged_path,
+    env_features,
+    out_dir=".",
+    file_format="png",
+    lefton="State",
+    righton="STUSPS",
+    mh_feature="MH_Score",
+    percentile=np.linspace(0.33, 1, 3),
+    color_list=["#ffb000", "#dc267f", "#648fff", "#785ef0"],
+    legend_position=[0, 0.1, 0.1, 0.1],
+    tick_fontsize=5,
+    label_fontsize=5,
+    x_label="Mental Illness Score Index",
+    y_labels=None,
+    title_fontsize=10,
+    dpi=150,
+    n_jobs=1,
+    basemap=True,
+    weight_col=None,
+):
+    """
+    Render the state-level bivariate choropleth map of every feature in env_features,
+    Return the list of saved image paths, one per feature.
+
+    Parameters:
+        geo_path: str, the state geo file or geo asset
+        merged_path: str, the merged data file
+        env_features: list, the environmental features to map
+        out_dir: str, the directory of the images
+        file_format: str, the image format, png, svg or pdf
+        y_labels: list, the legend label of every feature, "<feature> (Normalized)" if None
+        dpi: int, the resolution of the images
+        n_jobs: int, the number of processes rendering the features in parallel
+        basemap: bool, add the OpenStreetMap basemap
+        weight_col: str, the column weighting the urban centers in the state means, like "Population"
+    The other parameters are the same as one_function_bimap_state_level.
     """
-    Input file path for the geojson file and the merged data file,
+    env_features = list(env_features)
+    geo_df = cached_merge_geo_df(
+        geo_path,
+        merged_path,
+        lefton,
+        righton,
+        columns=[mh_feature, "State"] + env_features + ([weight_col] if weight_col else []),
+    )
+    state_df, env_classes, mh_classes = state_level_classes(
+        geo_df, env_features, mh_feature=mh_feature, percentile=percentile, weight_col=weight_col
+    )
+    colorlist = mikhailsirenko_colorscale(percentile, color_list)
+    colors = class_colors(colorlist, env_classes, mh_classes)
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_paths = [
+        os.path.join(out_dir, feature_file_name(f, file_format=file_format)) for f in env_features
+    ]
+    y_labels = y_labels or [f"{f} (Normalized)" for f in env_features]
+    render_kwargs = dict(
+        percentile=percentile,
+        legend_position=legend_position,
+        tick_fontsize=tick_fontsize,
+        label_fontsize=label_fontsize,
+        x_label=x_label,
+        title_fontsize=title_fontsize,
+        dpi=dpi,
+        basemap=basemap,
+    )
+
+    n_jobs = max(1, min(n_jobs, len(env_features)))
+    if n_jobs == 1:
+        return render_bimap_features(
+            state_df, env_features, colors, colorlist, out_paths, y_labels=y_labels, **render_kwargs
+        )
+
+    # every worker builds its own base figure and renders a contiguous chunk of the features
+    chunks = np.array_split(np.arange(len(env_features)), n_jobs)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [
+            pool.submit(
+                render_bimap_features,
+                state_df,
+                [env_features[k] for k in chunk],
+                colors[:, chunk],
+                colorlist,
+                [out_paths[k] for k in chunk],
+                y_labels=[y_labels[k] for k in chunk],
+                **render_kwargs,
+            )
+            for chunk in chunks
+        ]
+        return [path for future in futures for path in future.result()]
+
+
+def merge_geo_df(geo_path, merged_path_or_df, lefton, righton, columns=None):
+    """
+    Input file path for the geojson file or GeoParquet geo asset and the merged data file,
     Return the merged geodataframe with the key features
+
+    The merged data file can be a csv, parquet or feather file,
+    pass columns to only load those columns and the join key.
     """
-    geo_us = gpd.read_file(geo_path)
-    merged_df = pd.read_csv(merged_path_or_df, index_col=0)
+    import geopandas as gpd
+
+    # geo assets are memory-mapped and their geometries decoded after the merge
+    geo_asset = cm.file_format(geo_path) == "parquet"
+    if geo_asset:
+        geo_us = ga.read_geo_asset(geo_path, decode=False)
+    else:
+        geo_us = gpd.read_file(geo_path)
+    if isinstance(merged_path_or_df, pd.DataFrame):
+        merged_df = merged_path_or_df
+    elif columns is not None:
+        columns = list(dict.fromkeys([lefton] + list(columns)))
+        merged_df = cm.load_file_df(merged_path_or_df, columns=columns)
+    elif cm.file_format(merged_path_or_df) == "csv":
+        merged_df = pd.read_csv(merged_path_or_df, index_col=0)
+    else:
+        merged_df = cm.load_file_df(merged_path_or_df)
     merge_geo_df = merged_df.merge(geo_us, left_on=lefton, right_on=righton, how="left")
+    if geo_asset:
+        return ga.decode_geo_asset(merge_geo_df, crs=geo_us.attrs["crs"])
     geo_df = gpd.GeoDataFrame(merge_geo_df, geometry="geometry")
     return geo_df
 
 
+### In-process cache of merged geodataframes, so a batch of maps only reads and merges the files once.
+### Entries are keyed on the file paths, their modification times and the join keys, and evicted least recently used first.
+
+GEO_CACHE_SIZE = 8
+_geo_cache = OrderedDict()
+_geo_cache_stats = {"hits": 0, "misses": 0}
+
+
+def file_signature(file_path):
+    """
+    Return the absolute path, modification time and size of the file,
+    so that an edited file no longer matches its cached entries
+    """
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+def cached_merge_geo_df(
+    geo_path, merged_path_or_df, lefton, righton, columns=None, maxsize=GEO_CACHE_SIZE
+):
+    """
+    Memoized merge_geo_df.
+    The full merged geodataframe is cached once per (geo file, merged file, join keys),
+    and each call returns a deep copy, holding only the join key, columns and geometry if columns is given,
+    so that callers editing the result in place don't change the cached entry.
+    A dataframe passed as merged_path_or_df is not cached.
+    """
+    if isinstance(merged_path_or_df, pd.DataFrame):
+        return merge_geo_df(geo_path, merged_path_or_df, lefton, righton, columns=columns)
+
+    key = (file_signature(geo_path), file_signature(merged_path_or_df), lefton, righton)
+    if key in _geo_cache:
+        _geo_cache.move_to_end(key)
+        _geo_cache_stats["hits"] += 1
+    else:
+        _geo_cache_stats["misses"] += 1
+        # drop the entries of older versions of the same files
+        for stale in [
+            k for k in _geo_cache if (k[0][0], k[1][0], k[2:]) == (key[0][0], key[1][0], key[2:])
+        ]:
+            del _geo_cache[stale]
+        _geo_cache[key] = merge_geo_df(geo_path, merged_path_or_df, lefton, righton)
+        while len(_geo_cache) > maxsize:
+            _geo_cache.popitem(last=False)
+
+    geo_df = _geo_cache[key]
+    if columns is not None:
+        keep = list(dict.fromkeys([lefton] + list(columns) + [geo_df.geometry.name] + lod_cols(geo_df)))
+        return geo_df[keep].copy(deep=True)
+    return geo_df.copy(deep=True)
+
+
+def invalidate_geo_cache(file_path=None):
+    """
+    Drop the cached geodataframes read from file_path, or every cached geodataframe if file_path is None
+    """
+    if file_path is None:
+        _geo_cache.clear()
+        return None
+    abs_path = os.path.abspath(file_path)
+    for key in [k for k in _geo_cache if abs_path in (k[0][0], k[1][0])]:
+        del _geo_cache[key]
+    return None
+
+
+def geo_cache_info():
+    """
+    Return the number of cache hits, misses and cached geodataframes
+    """
+    return dict(_geo_cache_stats, size=len(_geo_cache), maxsize=GEO_CACHE_SIZE)
+
+
 def df_focused_env_feature(gdf, env_feature, other_features):
     """
     Input the merged geodataframe and the key features,
     Return the focused geodataframe with the key features
     """
+    import geopandas as gpd
 
-    focused_df = gdf[["geometry", "MH_Score", env_feature] + other_features]
+    cols = list(dict.fromkeys(["geometry", "MH_Score", env_feature] + other_features + lod_cols(gdf)))
+    # the columns are shared with gdf instead of copied
+    focused_df = gpd.GeoDataFrame(
+        {col: gdf[col] for col in cols}, geometry="geometry", crs=gdf.crs, copy=False
+    )
     return focused_df
 
 
-def normalize_features(df, env_feature, mh_feature="MH_Score"):
+def normalize_features(df, env_feature, mh_feature="MH_Score", method="minmax"):
     """
     Normalize the features to [0, 1] range
     In order to present the features in the same scale
+
+    The features are pulled into one float64 array and normalized together,
+    method can also be "zscore" or "rank", see feature_array_module.
     """
-    indf = df.copy()
-    for feature_name in [env_feature, mh_feature]:
-        indf[feature_name] = indf[feature_name].astype(float)
-        max_value = indf[feature_name].max()
-        min_value = indf[feature_name].min()
-        indf[feature_name] = (indf[feature_name] - min_value) / (max_value - min_value)
-    return indf
+    features = list(dict.fromkeys([env_feature, mh_feature]))
+    values = fa.feature_array(df, features)
+    fa.normalize(values, method, out=values)
+    return fa.with_columns(df, {feature: values[:, j] for j, feature in enumerate(features)})
 
 
 def hex_to_Color(hexcode):
@@ -146,6 +496,9 @@ def hex_to_Color(hexcode):
     More information: https://github.com/mikhailsirenko/bivariate-choropleth/blob/main/bivariate-choropleth.ipynb
 
     """
+    from generativepy.color import Color
+    from PIL import ImageColor
+
     rgb = ImageColor.getcolor(hexcode, "RGB")
     rgb = [v / 255 for v in rgb]  # normalize RGB values to [0,1] for matplotlib
     rgb = Color(
@@ -164,33 +517,10 @@ def mikhailsirenko_colorscale(
     Code from Mikhail Sirenko, slightly modified to fit our project
     More information: https://github.com/mikhailsirenko/bivariate-choropleth/blob/main/bivariate-choropleth.ipynb
 
+    The grid is computed with NumPy and cached by palette_module,
+    its shape follows the number of percentiles instead of a fixed 3x3.
     """
-
-    # basic colors for the gradient
-    c00 = hex_to_Color(color_list[0])
-    c10 = hex_to_Color(color_list[1])
-    c01 = hex_to_Color(color_list[2])
-    c11 = hex_to_Color(color_list[3])
-
-    # generate colorlist
-    num_grps = len(percentile)
-    c00_to_c10 = []
-    c01_to_c11 = []
-    colorlist = []
-    for i in range(num_grps):  # creating top and bottom horizontal color gradient
-        # Using lerp to compute intermediate color between two colors at position t
-        c00_to_c10.append(c00.lerp(c10, 1 / (num_grps - 1) * i))
-        c01_to_c11.append(c01.lerp(c11, 1 / (num_grps - 1) * i))
-
-    for i in range(num_grps):  # filling in the grid vertically
-        for j in range(num_grps):
-            colorlist.append(c00_to_c10[i].lerp(c01_to_c11[i], 1 / (num_grps - 1) * j))
-
-    # convert colorlist(rgba) back to RGB values
-    colorlist = [[c.r, c.g, c.b] for c in colorlist]
-
-    color_list = np.array(colorlist[::-1]).reshape(3, 3, 3)
-    return color_list
+    return pl.bivariate_color_grid(color_list, shape=(len(percentile), len(percentile)))
 
 
 def assign_color_cells(
@@ -204,25 +534,32 @@ def assign_color_cells(
     """
     Assigning color index to the cells based on the percentile of the features
     """
+    return fa.with_columns(
+        df,
+        {
+            env_color_01: color_num_series(df[env_col], percentile),
+            mh_color_02: color_num_series(df[mh_col], percentile),
+        },
+    )
 
-    def assign_color_num(x):
-        """
-        Helping function to assign color index to the cells
-        """
-        for n in range(len(percentile)):
-            if x <= percentile[n]:
-                return len(percentile) - 1 - n
 
-    indf = df.copy()
-    indf[env_color_01] = indf[env_col].apply(lambda x: assign_color_num(x))
-    indf[mh_color_02] = indf[mh_col].apply(lambda x: assign_color_num(x))
-    return indf
+def color_num_series(series, percentile):
+    """
+    Assign the color index of every cell of the column in one vectorized pass:
+    the index is len(percentile) - 1 - n for the first percentile[n] >= the value,
+    NaN for NaN values and values above the last percentile
+    """
+    classes = bn.classify(series.to_numpy(dtype=float), percentile, reverse=True)
+    if (classes < 0).any():
+        return pd.Series(np.where(classes < 0, np.nan, classes), index=series.index)
+    return pd.Series(classes, index=series.index)
 
 
 def mat_subplots(n_row, n_col, fig_size=(20, 10)):
     """
     Create subplots using matplotlib
     """
+    import matplotlib.pyplot as plt
 
     fig, ax = plt.subplots(n_row, n_col, figsize=fig_size)
     return fig, ax
@@ -240,12 +577,17 @@ def matplotlib_map(
     edge_color="black",
     line_width=0.35,
     figsize=(20, 10),
+    lod="auto",
 ):
     """
     Create bivariate choropleth map using matplotlib
+    lod: "auto" draws the coarsest level of detail of the geo asset that fits the extent, None the full geometries
     """
     ax.set_xlim(xlim[0], xlim[1])
     ax.set_ylim(ylim[0], ylim[1])
+    if lod == "auto":
+        lod = lod_column(df, ax)
+    df = with_lod(df, lod)
     df.plot(
         ax=ax,
         legend=False,
@@ -254,11 +596,61 @@ def matplotlib_map(
         edgecolor=edge_color,
         linewidth=line_width,
     )
-    cx.add_basemap(ax, crs=df.crs, source=cx.providers.OpenStreetMap.Mapnik)
+    add_basemap(ax, crs=df.crs)
 
     return ax
 
 
+def lod_cols(df):
+    """
+    Return the level of detail geometry columns of the dataframe
+    """
+    return [col for col in ga.LOD_TOLERANCES if col in df.columns]
+
+
+def lod_column(df, ax, dpi=None, width=None):
+    """
+    Return the coarsest level of detail column of df whose simplification tolerance is below the size of a pixel
+    of the axes, None for the full geometries.
+
+    Parameters:
+        df: geodataframe, with the level of detail columns of a geo asset
+        ax: axes, the axes the geometries are drawn in
+        dpi: int, the resolution the figure is saved at, the figure dpi if None
+        width: float, the width of the drawn extent in the crs units, the x limits of the axes if None
+    """
+    if df.crs is not None and not df.crs.is_geographic:
+        # the tolerances are in degrees
+        return None
+    if width is None:
+        xmin, xmax = ax.get_xlim()
+        width = abs(xmax - xmin)
+    fig = ax.get_figure()
+    width_px = ax.get_window_extent().width / fig.dpi * (dpi or fig.dpi)
+    pixel_size = width / max(width_px, 1)
+    fitting = [col for col in lod_cols(df) if ga.LOD_TOLERANCES[col] <= pixel_size]
+    return max(fitting, key=ga.LOD_TOLERANCES.get) if fitting else None
+
+
+def with_lod(df, lod):
+    """
+    Return the geodataframe drawing the lod level of detail column as its geometry, df itself if lod is None
+    """
+    import geopandas as gpd
+
+    if lod is None or lod not in df.columns:
+        return df
+    geometry = df[lod]
+    if not isinstance(geometry, gpd.GeoSeries):
+        # level of detail columns read from a geo asset are left as WKB until drawn
+        geometry = gpd.GeoSeries.from_wkb(
+            geometry.astype(object).where(geometry.notna(), None), index=df.index, crs=df.crs
+        )
+    lod_df = df.drop(columns=lod_cols(df))
+    lod_df[df.geometry.name] = geometry.set_crs(df.crs, allow_override=True)
+    return lod_df
+
+
 def set_off_axis(ax):
     """
     Set off axis for the map
@@ -304,6 +696,75 @@ def bicolor_legend(
     return None
 
 
+### Basemap source shared by all maps: an xyzservices provider, a tile url, a local raster file,
+### or a tile_module.TileCache to draw the basemap from cached tiles without network access.
+
+## example usage of set_basemap_source
+# map.set_basemap_source(tm.TileCache(path.tile_cache_dir))
+
+_basemap = {"source": None}
+
+
+def set_basemap_source(source=None):
+    """
+    Set the basemap source of all maps, None restores the OpenStreetMap Mapnik provider
+    """
+    _basemap["source"] = source
+    return None
+
+
+def add_basemap(ax, crs, source=None):
+    """
+    Add the basemap to the axes from source, or from the source set with set_basemap_source
+    """
+    import contextily as cx
+
+    source = source if source is not None else _basemap["source"]
+    if source is None:
+        source = cx.providers.OpenStreetMap.Mapnik
+    if isinstance(source, tm.TileCache):
+        source = source.mosaic_for_axes(ax, crs)
+    cx.add_basemap(ax, crs=crs, source=source)
+    return None
+
+
+def prefetch_basemap(extent, crs, source=None):
+    """
+    Download, or stitch from the tile cache, the basemap tiles of the (xmin, xmax, ymin, ymax) extent in crs,
+    so a later add_basemap of the same extent reads them from the contextily or tile_module cache
+    """
+    import contextily as cx
+
+    from pyproj import Transformer
+
+    source = source if source is not None else _basemap["source"]
+    if source is None:
+        source = cx.providers.OpenStreetMap.Mapnik
+    if isinstance(source, str) and os.path.exists(source):
+        # local raster files have nothing to fetch
+        return None
+    xmin, xmax, ymin, ymax = extent
+    w, s, e, n = Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform_bounds(
+        xmin, ymin, xmax, ymax
+    )
+    if isinstance(source, tm.TileCache):
+        source.mosaic(w, max(s, -85.0511), e, min(n, 85.0511))
+    else:
+        cx.bounds2img(w, s, e, n, zoom="auto", source=source, ll=True)
+    return None
+
+
+def prefetch_basemaps(extents, crs, source=None, max_workers=8):
+    """
+    Prefetch the basemap tiles of every extent concurrently in a thread pool,
+    a TileCache source downloads and stitches every shared tile and mosaic once under its per-key locks
+    """
+    extents = list(dict.fromkeys(tuple(extent) for extent in extents))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(extents)))) as pool:
+        list(pool.map(lambda extent: prefetch_basemap(extent, crs, source), extents))
+    return None
+
+
 ### Below functions is consolidate function to plot a 2X3 subplots monovariate choropleth map
 
 ## example usage of one_function_monoMap_six_urban_centers
@@ -345,52 +806,247 @@ def one_function_monoMap_six_urban_centers(
     legend_title="Mental Illness Score Index",
 ):
     """
-    Consolidate all functions to plot a 2X3 subplots monovariate choropleth map
+    Consolidate all functions to plot a 2X3 subplots monovariate choropleth map,
+    see monoMap_urban_centers for any number of urban centers and grid shape.
+    legend_position is in the axes coordinates of the last panel, like mono_color_legend.
     """
-    print("It may take 30s to 1min to generate the map, but it is worth waiting :D")
-
-    geo_df = merge_geo_df(geo_path, merge_path, lefton, righton)
-    focused_df = df_focused_env_feature(geo_df, env_feature, other_features)
-    normalized_df = normalize_features(focused_df, env_feature, mh_feature)
-    color_list = mono_mikhailsirenko_colorscale(percentile, colorlst)
-    color_df = mono_assign_color_cells(normalized_df, mh_col, mh_color_02, percentile)
-
-    _, ax = plt.subplots(fig_row, fig_col, figsize=fig_size)
-    for i in range(fig_row):
-        n = i
-        if i > 0:
-            n = 3
-        for j in range(fig_col):
-            map_urban_center(
-                color_df,
-                ax[i, j],
-                urban_center_lst[n + j],
-                color_list,
-                alpha=0.7,
-                mh_color_02="mh_color",
-                filter_col="Urban Center",
-                edgecolor="black",
-                linewidth=0.5,
-            )
-            set_off_axis(ax[i, j])
-            ax[i, j].set_title(
-                f"Normalized Mental Illness Score of Urban Center: {urban_center_lst[n + j]}, {geo_df[geo_df['Urban Center'] == urban_center_lst[n + j]]['State'].values[0]}",
-                fontsize=plot_title_fontsize,
-            )
-
-    mono_color_legend(
-        ax[1, 2],
-        color_list,
+    monoMap_urban_centers(
+        geo_path,
+        merge_path,
+        urban_center_lst[: fig_row * fig_col],
+        grid=(fig_row, fig_col),
+        lefton=lefton,
+        righton=righton,
+        env_feature=env_feature,
+        other_features=other_features,
+        mh_feature=mh_feature,
         percentile=percentile,
+        colorlst=colorlst,
+        mh_col=mh_col,
+        mh_color_02=mh_color_02,
+        fig_size=fig_size,
+        alpha=alpha,
+        filter_col=filter_col,
+        edgecolor=edgecolor,
+        linewidth=linewidth,
+        plot_title_fontsize=plot_title_fontsize,
         legend_position=legend_position,
+        legend_panel=fig_row * fig_col - 1,
         tick_fontsize=tick_fontsize,
         label_fontsize=label_fontsize,
-        title=legend_title,
+        legend_title=legend_title,
     )
+    return None
+
+
+### Below monoMap_urban_centers plots the monovariate choropleth map of any number of urban centers as small multiples.
+### The merged geodataframe is grouped by urban center once, the basemap tiles of all panels are fetched
+### concurrently in a thread pool, and with n_jobs > 1 the panels are rendered in a process pool
+### and composited into the grid.
 
+## example usage of monoMap_urban_centers
+# map.monoMap_urban_centers(geo_data, merged_data, ['Cary', 'Flint', 'Boston', 'Austin'], grid=(2, 2))
+
+
+def panel_grid(n_panels, grid=None, max_cols=3):
+    """
+    Return the (rows, cols) shape of the panel grid: grid if given, otherwise rows of at most max_cols panels
+    """
+    if grid is None:
+        n_cols = max(1, min(n_panels, max_cols))
+        return -(-n_panels // n_cols), n_cols
+    if grid[0] * grid[1] < n_panels:
+        raise ValueError(f"a {grid[0]}x{grid[1]} grid can't hold {n_panels} panels")
+    return tuple(grid)
+
+
+def group_panels(df, filter_col, names):
+    """
+    Group df on filter_col once and return the rows of every name in names, in order
+    """
+    positions = df.groupby(filter_col, sort=False).indices
+    missing = [name for name in names if name not in positions]
+    if missing:
+        raise KeyError(f"{missing} not found in {filter_col}")
+    return [df.iloc[positions[name]] for name in names]
+
+
+def panel_title(panel_df, name, state_col="State"):
+    state = panel_df[state_col].iloc[0] if state_col in panel_df.columns else None
+    location = f"{name}, {state}" if state is not None else name
+    return f"Normalized Mental Illness Score of Urban Center: {location}"
+
+
+def plot_urban_center(
+    fil_df,
+    ax,
+    colorlist,
+    mh_color_02="mh_color",
+    edgecolor="black",
+    linewidth=0.5,
+    alpha=1,
+    lod="auto",
+):
+    """
+    Plot the rows of one urban center with their mono-variate colors, without the basemap
+    """
+    if lod == "auto":
+        xmin, _, xmax, _ = fil_df.total_bounds
+        lod = lod_column(fil_df, ax, width=xmax - xmin)
+    fil_df = with_lod(fil_df, lod)
+    fil_df.plot(
+        ax=ax,
+        color=colorlist[0][fil_df[mh_color_02]][0].tolist(),
+        alpha=alpha,
+        edgecolor=edgecolor,
+        linewidth=linewidth,
+    )
     return None
 
 
+def render_panel(panel_df, colorlist, title, panel_size, dpi=100, source=None, basemap=True, title_fontsize=10, **plot_kwargs):
+    """
+    Render one urban center panel with its basemap and title on its own Agg canvas,
+    Return the RGBA image array, so the panels can be rendered in worker processes
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=panel_size, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    plot_urban_center(panel_df, ax, colorlist, **plot_kwargs)
+    if basemap:
+        add_basemap(ax, crs=panel_df.crs, source=source)
+    set_off_axis(ax)
+    ax.set_title(title, fontsize=title_fontsize)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def monoMap_urban_centers(
+    geo_path,
+    merge_path,
+    urban_center_lst,
+    grid=None,
+    lefton="UC_Grouping",
+    righton="UC_Grouping",
+    env_feature="Longitude",
+    other_features=["Urban Center", "State"],
+    mh_feature="MH_Score",
+    percentile=np.linspace(0.2, 1, 5),
+    colorlst=["#FF0000", "#0000FF"],
+    mh_col="MH_Score",
+    mh_color_02="mh_color",
+    fig_size=None,
+    alpha=0.7,
+    filter_col="Urban Center",
+    edgecolor="black",
+    linewidth=0.5,
+    plot_title_fontsize=10,
+    legend_position=None,
+    legend_panel=None,
+    tick_fontsize=6,
+    label_fontsize=8,
+    legend_title="Mental Illness Score Index",
+    basemap=True,
+    basemap_workers=8,
+    n_jobs=1,
+    dpi=100,
+):
+    """
+    Plot the monovariate choropleth map of every urban center in urban_center_lst in a grid of panels.
+
+    Parameters:
+        urban_center_lst: list, the urban centers, one panel each
+        grid: tuple, the (rows, cols) of the grid, rows of 3 panels if None
+        fig_size: tuple, the figure size, 6 x 5 inches per panel if None
+        legend_position: list, the [left, bottom, width, height] of the legend in figure coordinates,
+            centered under the grid if None
+        legend_panel: int, the index of the panel whose axes coordinates legend_position is given in instead,
+            like mono_color_legend, the grid then keeps the default margins
+        basemap: bool, add the OpenStreetMap basemap, or the source set with set_basemap_source
+        basemap_workers: int, the number of threads fetching the basemap tiles of the panels
+        n_jobs: int, the number of processes rendering the panels, which are then composited into the grid
+        dpi: int, the resolution of the panels rendered by the processes
+    The other parameters are the same as one_function_monoMap_six_urban_centers.
+    Return the figure and the array of axes.
+    """
+    import matplotlib.pyplot as plt
+
+    geo_df = cached_merge_geo_df(
+        geo_path,
+        merge_path,
+        lefton,
+        righton,
+        columns=[mh_feature, env_feature, filter_col, "State"] + other_features,
+    )
+    focused_df = df_focused_env_feature(geo_df, env_feature, other_features + [filter_col, "State"])
+    normalized_df = normalize_features(focused_df, env_feature, mh_feature)
+    color_list = mono_mikhailsirenko_colorscale(percentile, colorlst)
+    color_df = mono_assign_color_cells(normalized_df, mh_col, mh_color_02, percentile)
+
+    panels = group_panels(color_df, filter_col, urban_center_lst)
+    titles = [panel_title(panel, name) for panel, name in zip(panels, urban_center_lst)]
+    n_rows, n_cols = panel_grid(len(panels), grid)
+    fig_size = fig_size or (6 * n_cols, 5 * n_rows)
+    fig, ax = plt.subplots(n_rows, n_cols, figsize=fig_size, squeeze=False)
+    axes = ax.ravel()
+    plot_kwargs = dict(mh_color_02=mh_color_02, alpha=alpha, edgecolor=edgecolor, linewidth=linewidth)
+
+    # the legend sits in figure coordinates under the grid, the panels share the space above it
+    if legend_panel is None:
+        legend_position = legend_position or grid_legend_position(fig_size, n_cols, len(percentile))
+        legend_top = legend_position[1] + legend_position[3] + 0.3 / fig_size[1]
+        fig.subplots_adjust(bottom=legend_top)
+
+    if n_jobs > 1:
+        # every panel is rendered on its own canvas by a worker, then fills its cell of the grid
+        fig.subplots_adjust(left=0, right=1, top=1, wspace=0, hspace=0)
+        bbox = fig.subplotpars
+        panel_size = (fig_size[0] / n_cols, fig_size[1] * (bbox.top - bbox.bottom) / n_rows)
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(panels))) as pool:
+            futures = [
+                pool.submit(
+                    render_panel,
+                    panel,
+                    color_list,
+                    title,
+                    panel_size,
+                    dpi=dpi,
+                    source=_basemap["source"],
+                    basemap=basemap,
+                    title_fontsize=plot_title_fontsize,
+                    **plot_kwargs,
+                )
+                for panel, title in zip(panels, titles)
+            ]
+            for axis, future in zip(axes, futures):
+                axis.imshow(future.result(), aspect="auto")
+                axis.margins(0)
+    else:
+        for axis, panel, title in zip(axes, panels, titles):
+            plot_urban_center(panel, axis, color_list, **plot_kwargs)
+            axis.set_title(title, fontsize=plot_title_fontsize)
+        if basemap:
+            # download the tiles of all panels at once, each add_basemap then reads them from the cache
+            prefetch_basemaps([axis.axis() for axis in axes[: len(panels)]], color_df.crs, max_workers=basemap_workers)
+            for axis in axes[: len(panels)]:
+                add_basemap(axis, crs=color_df.crs)
+    for axis in axes:
+        set_off_axis(axis)
+
+    legend_kwargs = dict(
+        percentile=percentile, tick_fontsize=tick_fontsize, label_fontsize=label_fontsize, title=legend_title
+    )
+    if legend_panel is None:
+        draw_mono_legend(fig.add_axes(legend_position), color_list, **legend_kwargs)
+    else:
+        mono_color_legend(axes[legend_panel], color_list, legend_position=legend_position, **legend_kwargs)
+
+    return fig, ax
+
+
 def mono_mikhailsirenko_colorscale(
     percentile=np.linspace(0.2, 1, 5), color_list=["#808080", "#FF0000"]
 ):
@@ -400,22 +1056,9 @@ def mono_mikhailsirenko_colorscale(
     Code from Mikhail Sirenko, slightly modified to fit our project
     More information: https://github.com/mikhailsirenko/bivariate-choropleth/blob/main/bivariate-choropleth.ipynb
 
+    The scale is computed with NumPy and cached by palette_module.
     """
-    # basic colors for the gradient
-    c00 = hex_to_Color(color_list[0])
-    c10 = hex_to_Color(color_list[1])
-
-    # generate colorlist
-    num_grps = len(percentile)
-    colorlist = []
-    for i in range(num_grps):
-        colorlist.append(c00.lerp(c10, 1 / (num_grps - 1) * i))
-
-    # convert colorlist(rgba) back to RGB values
-    colorlist = [[c.r, c.g, c.b] for c in colorlist]
-
-    color_list = np.array(colorlist).reshape(1, -1, 3)
-    return color_list
+    return pl.mono_color_scale(color_list, len(percentile))
 
 
 def mono_assign_color_cells(
@@ -427,18 +1070,37 @@ def mono_assign_color_cells(
     """
     Assigning color index to the cells based on the percentile of the features
     """
+    return fa.with_columns(df, {mh_color_02: color_num_series(df[mh_col], percentile)})
 
-    def assign_color_num(x):
-        """
-        Helping function to assign color index to the cells
-        """
-        for n in range(len(percentile)):
-            if x <= percentile[n]:
-                return len(percentile) - 1 - n
 
-    indf = df.copy()
-    indf[mh_color_02] = indf[mh_col].apply(lambda x: assign_color_num(x))
-    return indf
+def urban_center_at(lon, lat, index=None):
+    """
+    Return the key of the urban center containing the point, or of the nearest urban center.
+    index defaults to the spatial index of the Greenspace_US footprints, loaded or built alongside the geo asset.
+    """
+    if index is None:
+        index = si.load_or_build_index()
+    containing = index.query_point(lon, lat)
+    if len(containing):
+        return containing[0]
+    return index.nearest(lon, lat)[0]
+
+
+def select_urban_centers(gdf, bbox=None, point=None, index=None, key_col="UC_Grouping"):
+    """
+    Return the rows of gdf of the urban centers intersecting the bbox (xmin, ymin, xmax, ymax),
+    or containing the (lon, lat) point, looked up in the spatial index of the urban center footprints,
+    by default the one of the Greenspace_US footprints
+    """
+    if index is None:
+        index = si.load_or_build_index()
+    if bbox is not None:
+        keys = index.query_bbox(*bbox)
+    elif point is not None:
+        keys = index.query_point(*point)
+    else:
+        raise ValueError("bbox or point must be given")
+    return gdf[gdf[key_col].isin(keys)]
 
 
 def map_urban_center(
@@ -451,16 +1113,29 @@ def map_urban_center(
     edgecolor="black",
     linewidth=0.5,
     alpha=1,
+    lod="auto",
+    index=None,
+    key_col="UC_Grouping",
 ):
-    fil_df = gdf[gdf[filter_col] == urban_center]
-    fil_df.plot(
-        ax=ax,
-        color=colorlist[0][fil_df["mh_color"]][0].tolist(),
-        alpha=alpha,
+    """
+    Map the urban center named urban_center in filter_col,
+    or the urban center at or nearest to the (lon, lat) point urban_center in the spatial index of the footprints
+    """
+    if isinstance(urban_center, tuple):
+        fil_df = gdf[gdf[key_col] == urban_center_at(*urban_center, index=index)]
+    else:
+        fil_df = gdf[gdf[filter_col] == urban_center]
+    plot_urban_center(
+        fil_df,
+        ax,
+        colorlist,
+        mh_color_02=mh_color_02,
         edgecolor=edgecolor,
         linewidth=linewidth,
+        alpha=alpha,
+        lod=lod,
     )
-    cx.add_basemap(ax, crs=gdf.crs, source=cx.providers.OpenStreetMap.Mapnik)
+    add_basemap(ax, crs=gdf.crs)
     return None
 
 
@@ -476,7 +1151,28 @@ def mono_color_legend(
     """
     Insert mono-variate choropleth map legend
     """
-    ax = ax.inset_axes(legend_position)
+    draw_mono_legend(
+        ax.inset_axes(legend_position),
+        color_list,
+        percentile=percentile,
+        tick_fontsize=tick_fontsize,
+        label_fontsize=label_fontsize,
+        title=title,
+    )
+    return None
+
+
+def draw_mono_legend(
+    ax,
+    color_list,
+    percentile=np.linspace(0.2, 1, 5),
+    tick_fontsize=6,
+    label_fontsize=8,
+    title="Mental Illness Score",
+):
+    """
+    Draw the mono-variate choropleth map legend in the axes
+    """
     ax.set_aspect("equal", adjustable="box")
 
     ax.imshow(color_list)
@@ -491,3 +1187,121 @@ def mono_color_legend(
     ax.set_yticks([])
     ax.set_title(title, fontsize=label_fontsize, y=-0.7)
     return None
+
+
+def grid_legend_position(fig_size, n_cols, n_cells, width=0.6, bottom=0.6):
+    """
+    Return the [left, bottom, width, height] figure coordinates of the mono-variate legend centered under a grid
+    of n_cols panels, width panels wide with square color cells, bottom inches above the figure edge
+    """
+    fig_width, fig_height = fig_size
+    legend_width = width / n_cols
+    legend_height = legend_width * fig_width / n_cells / fig_height
+    return [(1 - legend_width) / 2, bottom / fig_height, legend_width, legend_height]
+
+
+### Below merged_choropleth_map is the interactive folium choropleth map of the archived map module.
+### The tooltip values are joined to the GeoJSON features by key: the key -> values dictionary is built once,
+### then every feature is filled with one lookup, instead of scanning the dataframe per feature and column.
+
+## example usage of merged_choropleth_map
+# m = map.merged_choropleth_map(geo_data, merged_df, ["Urban Center", "State", "MH_Score"], geo_col=["UC_Grouping", "MH_Score"])
+# m.save("map.html")
+
+
+def tooltip_value(value):
+    """
+    Format a tooltip value like the archived map: integers for numbers, "N/A" for missing or falsy values
+    """
+    if pd.isna(value) or not value:
+        return "N/A"
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def tooltip_records(df, key_col, col_list):
+    """
+    Return the dictionary of key to the formatted tooltip values of the first row of the key, built in one pass
+    """
+    rows = df.drop_duplicates(key_col)
+    columns = [[tooltip_value(v) for v in rows[col].tolist()] for col in col_list]
+    return {
+        key: dict(zip(col_list, values))
+        for key, values in zip(rows[key_col].tolist(), zip(*columns))
+    }
+
+
+def add_tooltip_properties(features, df, key_col, key, col_list):
+    """
+    Write the tooltip values of col_list of df into the properties of every GeoJSON feature, in place,
+    features are matched on properties[key] == df[key_col], unmatched features get "N/A"
+    """
+    records = tooltip_records(df, key_col, col_list)
+    missing = dict.fromkeys(col_list, "N/A")
+    for feature in features:
+        properties = feature["properties"]
+        properties.update(records.get(properties.get(key), missing))
+    return features
+
+
+def merged_choropleth_map(
+    boundary_file_path,
+    df,
+    col_list,
+    lat=39.5,
+    lon=-98.35,
+    geo_col=["UC_Grouping", "MHLTH_AdjPrev"],
+    key="UC_Grouping",
+    color="YlGnBu",
+    opacity=0.7,
+    weight=1,
+    zoom_start=5,
+    legend="Average Mental Health Prevalence (%)",
+):
+    """
+    Input boundary_file_path, df need to be plotted, col_list to be shown in tooltip, lat, lon, geo_col, key, color, opacity, weight, zoom_start, legend,
+    Returns choropleth map
+
+    Parameters:
+        boundary_file_path: str, path of boundary geojson file
+        df: pd.DataFrame, data to be plotted
+        col_list: list, list of columns to be shown in tooltip
+        lat: float, latitude of the map
+        lon: float, longitude of the map
+        geo_col: list, the key column of df and the column to be plotted
+        key: str, key property of the geojson features
+        color: str, color of the map
+        opacity: float, opacity of the map
+        weight: int, weight of the line
+        zoom_start: int, zoom level of the map
+        legend: str, legend of the map
+    """
+    import json
+
+    import folium
+
+    m = folium.Map(location=[lat, lon], zoom_start=zoom_start)
+
+    with open(boundary_file_path, "r") as f:
+        geodata = json.load(f)
+
+    cp = folium.Choropleth(
+        geo_data=geodata,
+        data=df,
+        columns=geo_col,
+        key_on="feature.properties." + key,
+        fill_color=color,
+        fill_opacity=opacity,
+        line_weight=weight,
+        legend_name=legend,
+    ).add_to(m)
+
+    # add the tooltip values to the geojson features, then the labels through GeoJsonTooltip
+    add_tooltip_properties(cp.geojson.data["features"], df, geo_col[0], key, col_list)
+    folium.GeoJsonTooltip(fields=col_list, aliases=[col + ": " for col in col_list]).add_to(
+        cp.geojson
+    )
+
+    return m
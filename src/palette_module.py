@@ -0,0 +1,96 @@
+from functools import lru_cache
+
+import numpy as np
+
+### Vectorized color scales for the choropleth maps.
+### Same gradients as the Mikhail Sirenko colorscale built with generativepy Color.lerp, computed with NumPy
+### and memoized per (hex colors, grid shape), so repeated map calls don't rebuild them.
+### More information: https://github.com/mikhailsirenko/bivariate-choropleth/blob/main/bivariate-choropleth.ipynb
+
+## example usage of bivariate_color_grid
+# bivariate_color_grid(["#ffb000", "#dc267f", "#648fff", "#785ef0"], shape=(3, 3))
+
+
+def hex_to_rgb(hexcode):
+    """
+    Convert a #rgb or #rrggbb hex color code to RGB values normalized to [0, 1],
+    other color strings are converted with PIL ImageColor
+    """
+    code = hexcode.lstrip("#")
+    if hexcode.startswith("#") and len(code) in (3, 6):
+        if len(code) == 3:
+            code = "".join(c * 2 for c in code)
+        rgb = [int(code[i : i + 2], 16) for i in (0, 2, 4)]
+    else:
+        from PIL import ImageColor
+
+        rgb = ImageColor.getcolor(hexcode, "RGB")
+    return np.array(rgb) / 255
+
+
+def lerp(c0, c1, t):
+    """
+    Interpolate between the colors c0 and c1 at the positions t, like generativepy Color.lerp
+    """
+    return np.clip(c0 * (1 - t) + c1 * t, 0, 1)
+
+
+def steps(n):
+    """
+    Return the n interpolation positions 0, 1 / (n - 1), ..., 1
+    """
+    return 1 / max(n - 1, 1) * np.arange(n)
+
+
+@lru_cache(maxsize=64)
+def _bivariate_color_grid(color_list, n_rows, n_cols):
+    c00, c10, c01, c11 = [hex_to_rgb(c) for c in color_list]
+    t_rows = steps(n_rows)[:, np.newaxis]
+    t_cols = steps(n_cols)[:, np.newaxis, np.newaxis]
+
+    # top and bottom gradients, then the grid filled in between them
+    c00_to_c10 = lerp(c00, c10, t_rows)
+    c01_to_c11 = lerp(c01, c11, t_rows)
+    grid = lerp(c00_to_c10, c01_to_c11, t_cols)
+
+    # (col, row) order flipped on both axes, as the original reversed colorlist
+    grid = grid.transpose(1, 0, 2)[::-1, ::-1]
+    grid = np.ascontiguousarray(grid)
+    grid.setflags(write=False)
+    return grid
+
+
+@lru_cache(maxsize=64)
+def _mono_color_scale(color_list, n):
+    c00, c10 = [hex_to_rgb(c) for c in color_list[:2]]
+    scale = lerp(c00, c10, steps(n)[:, np.newaxis]).reshape(1, -1, 3)
+    scale.setflags(write=False)
+    return scale
+
+
+def bivariate_color_grid(color_list, shape=(3, 3)):
+    """
+    Return the (rows, cols, 3) RGB color grid of a bivariate choropleth map.
+
+    Parameters:
+        color_list: list, the 4 corner hex colors c00, c10, c01 and c11
+        shape: tuple, the number of classes of the first (rows) and second (cols) feature
+    """
+    return _bivariate_color_grid(tuple(color_list), shape[0], shape[1]).copy()
+
+
+def mono_color_scale(color_list, n):
+    """
+    Return the (1, n, 3) RGB color scale of a mono-variate choropleth map from the first to the second hex color
+    """
+    return _mono_color_scale(tuple(color_list), n).copy()
+
+
+def palette_cache_info():
+    """
+    Return the cache statistics of the bivariate and mono palettes
+    """
+    return {
+        "bivariate": _bivariate_color_grid.cache_info(),
+        "mono": _mono_color_scale.cache_info(),
+    }
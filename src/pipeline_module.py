@@ -0,0 +1,242 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import city_index_module as ci
+import clean_merge_module as cm
+import file_path as fp
+import spatial_index_module as si
+
+### Scripted version of data_cleaning_merge.ipynb
+### Every stage is a cached node keyed by the hash of its code, its inputs and its parameters,
+### so only the stages whose inputs changed are re-run.
+
+## example usage of run_pipeline, from the src directory
+# python pipeline_module.py
+# python pipeline_module.py --force
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    Return the sha256 hash of the file content
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def func_sources(func, modules=(cm, ci, si), seen=None):
+    """
+    Return the source code of func and of the functions of modules it calls,
+    so that editing a cleaning function invalidates the stages using it
+    """
+    seen = set() if seen is None else seen
+    if (func.__module__, func.__name__) in seen:
+        return []
+    seen.add((func.__module__, func.__name__))
+    sources = [inspect.getsource(func)]
+    for name in func.__code__.co_names:
+        for module in modules:
+            called = getattr(module, name, None)
+            if inspect.isfunction(called) and called.__module__ == module.__name__:
+                sources += func_sources(called, modules, seen)
+    return sources
+
+
+class Source:
+    """
+    Pipeline input file, keyed by the hash of its content.
+    A missing file fails with the download_url to get it from, before any stage is run.
+    """
+
+    def __init__(self, file_path, download_url=None):
+        self.name = os.path.basename(file_path)
+        self.file_path = file_path
+        self.download_url = download_url
+        self._key = None
+
+    def key(self):
+        if self._key is None:
+            cm.require_file(self.file_path, self.download_url)
+            self._key = file_hash(self.file_path)
+        return self._key
+
+    def value(self, cache_dir, force=False):
+        return self.file_path
+
+
+class Stage:
+    """
+    Cached pipeline node.
+    The key hashes the stage code, the keys of its inputs and its parameters,
+    and the output is pickled in cache_dir under that key.
+    Upstream stages are only loaded or run when this stage is stale.
+    """
+
+    def __init__(self, name, func, inputs=[], params={}):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params
+        self.status = "up to date"
+        self._key = None
+        self._value = None
+
+    def key(self):
+        if self._key is None:
+            payload = json.dumps(
+                {
+                    "name": self.name,
+                    "code": func_sources(self.func),
+                    "inputs": [x.key() for x in self.inputs],
+                    "params": self.params,
+                },
+                sort_keys=True,
+                default=repr,
+            )
+            self._key = hashlib.sha256(payload.encode()).hexdigest()
+        return self._key
+
+    def cache_file(self, cache_dir):
+        return os.path.join(cache_dir, f"{self.name}-{self.key()[:16]}.pkl")
+
+    def value(self, cache_dir, force=False):
+        if self._value is not None:
+            return self._value
+
+        cache_file = self.cache_file(cache_dir)
+        if os.path.exists(cache_file) and not force:
+            with open(cache_file, "rb") as f:
+                self._value = pickle.load(f)
+            self.status = "cached"
+        else:
+            args = [x.value(cache_dir, force) for x in self.inputs]
+            self._value = self.func(*args, **self.params)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump(self._value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+            self.status = "ran"
+        return self._value
+
+
+def mh_clean_stage(mh_path, col_lst=["PlaceFIPS", "MHLTH_CrudePrev", "MHLTH_Crude95CI"]):
+    """
+    Load the raw mental health file, remove the other chronic diseases and parse Geolocation into latitude and longitude columns
+    """
+    mh_raw = cm.load_file_df(mh_path)
+    mh_data = cm.mh_remove_chronics(mh_raw)
+    return cm.mh_clean_transfrom(mh_data, col_lst=col_lst, trans_col="Geolocation")
+
+
+def gs_clean_stage(gs_path):
+    """
+    Stream the raw greenspace file keeping the US urban centers and the selected columns, and fix city names
+    """
+    gs_df = cm.load_gs_csv(gs_path)
+    return cm.gs_fix_city_names(gs_df)
+
+
+def state_tag_stage(gs_df, state_path):
+    """
+    Assign the state, region and division of every urban center
+    """
+    gs_df = cm.assign_state(gs_df, state_path)
+    gs_df = cm.apply_geo_labels(gs_df, "Region", cm.us_region(), "State")
+    gs_df = cm.apply_geo_labels(gs_df, "Division", cm.us_division(), "State")
+    return gs_df
+
+
+def city_match_stage(gs_df, mh_df):
+    """
+    Match the mental health cities to the urban centers with the (city, state) name index
+    """
+    return ci.match_cities(gs_df, mh_df)
+
+
+def build_pipeline(
+    mh_path=fp.mh_file, gs_path=fp.gs_raw_file, state_path=fp.state_boundaries_file
+):
+    """
+    Build the cleaning and merging stages.
+    Return a dictionary of stage name to Stage.
+    """
+    mh_clean = Stage("mh_clean", mh_clean_stage, [Source(mh_path)])
+    gs_clean = Stage("gs_clean", gs_clean_stage, [Source(gs_path, cm.GS_DOWNLOAD_URL)])
+    state_tag = Stage(
+        "state_tag", state_tag_stage, [gs_clean, Source(state_path, cm.STATE_BOUNDARIES_URL)]
+    )
+    city_match = Stage("city_match", city_match_stage, [state_tag, mh_clean])
+    merge = Stage("merge", cm.merge_mh_gs, [mh_clean, city_match])
+    aggregate = Stage("aggregate", cm.aggregate_uc, [merge])
+    return {
+        stage.name: stage
+        for stage in [mh_clean, gs_clean, state_tag, city_match, merge, aggregate]
+    }
+
+
+def run_pipeline(
+    mh_path=fp.mh_file,
+    gs_path=fp.gs_raw_file,
+    state_path=fp.state_boundaries_file,
+    cache_dir=fp.pipeline_cache_dir,
+    outputs=[
+        ("mh_clean", fp.mh_cleaned, {"index": False}),
+        ("city_match", fp.gs_cleaned, {"index": True}),
+        ("aggregate", fp.merged_data_file, {"index": True}),
+        ("aggregate", fp.merged_data_parquet, {"categorical_cols": cm.MERGED_CATEGORICAL_COLS}),
+    ],
+    force=False,
+):
+    """
+    Run the stale stages of the pipeline and write the output files.
+
+    Parameters:
+        mh_path: str, the raw mental health file
+        gs_path: str, the raw greenspace file
+        state_path: str, the state boundaries shapefile
+        cache_dir: str, the directory of the cached stage outputs
+        outputs: list of (stage name, output file path, save_csv keyword arguments)
+        force: bool, re-run every stage even if it is cached
+    Return the dictionary of stages.
+    """
+    stages = build_pipeline(mh_path, gs_path, state_path)
+    # key every stage first, so a missing input file fails before any stage is run
+    for stage in stages.values():
+        stage.key()
+
+    # outputs are only rewritten when the key of the stage producing them changed
+    manifest_file = os.path.join(cache_dir, "outputs.json")
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    for name, out_path, save_kwargs in outputs:
+        stage = stages[name]
+        if force or manifest.get(out_path) != stage.key() or not os.path.exists(out_path):
+            cm.save_csv(stage.value(cache_dir, force=force), out_path, overwrite=True, **save_kwargs)
+            manifest[out_path] = stage.key()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    for stage in stages.values():
+        print(f"{stage.name}: {stage.status}")
+    return stages
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the cleaning and merging pipeline")
+    parser.add_argument("--force", action="store_true", help="re-run every stage")
+    parser.add_argument("--cache-dir", default=fp.pipeline_cache_dir)
+    args = parser.parse_args()
+    run_pipeline(cache_dir=args.cache_dir, force=args.force)
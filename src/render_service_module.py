@@ -0,0 +1,448 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
+import numpy as np
+import shapely
+
+import binning_module as bn
+import feature_array_module as fa
+import file_path as fp
+import map_module as mm
+
+### Headless map rendering service, so dashboards can request the bivariate choropleth maps over HTTP.
+### A map spec (feature, level, palette, percentiles, extent, format) is rendered on its own Agg or SVG canvas,
+### without pyplot figures, and the image bytes are stored in a content-addressed disk cache keyed by the
+### hash of the spec and of the data version, the signatures of the geo and merged data files.
+### The cache is bounded in size and evicts the least recently used images first.
+
+## example usage of MapRenderer, in python or through the local server
+# renderer = rs.MapRenderer()
+# png = renderer.render({"feature": "Avg Greenness", "level": "State"})[0]
+# server, url = rs.serve_maps(renderer, port=8000)
+# curl "http://127.0.0.1:8000/map.svg?feature=Avg%20Greenness&level=Urban%20Center&extent=-84,42.9,-83.5,43.2"
+
+RENDER_VERSION = 1  # bump when the drawing changes, so the cached images are rendered again
+
+# level -> (geo file, join key of the merged data, join key of the geo file)
+LEVEL_LAYERS = {
+    "Urban Center": (fp.geo_us_asset, "UC_Grouping", "UC_Grouping"),
+    "State": (fp.state_geo_asset, "State", "STUSPS"),
+    "Division": (fp.division_geo_asset, "Division", "Division"),
+    "Region": (fp.region_geo_asset, "Region", "Region"),
+}
+
+DEFAULT_SPEC = {
+    "feature": "Avg Greenness",
+    "mh_feature": "MH_Score",
+    "level": "State",
+    "palette": ["#ffb000", "#dc267f", "#648fff", "#785ef0"],
+    "percentiles": np.linspace(0.33, 1, 3).tolist(),
+    "extent": [-125, 25, -66.7, 50],  # west, south, east, north
+    "format": "png",
+    "size": [1200, 800],  # width and height in pixels, before the tight crop
+    "dpi": 100,
+    "basemap": False,
+    "title": True,
+}
+FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def float_list(value):
+    """
+    Return the list of floats of a list or of a comma separated string, like "-125,25,-66.7,50"
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    return [float(v) for v in value]
+
+
+def normalize_spec(spec):
+    """
+    Fill a map spec with the defaults and check its values, so equal maps have equal specs,
+    Return the spec dictionary, raise ValueError for an invalid spec
+    """
+    unknown = set(spec) - set(DEFAULT_SPEC)
+    if unknown:
+        raise ValueError(f"unknown map spec keys: {sorted(unknown)}")
+    spec = {**DEFAULT_SPEC, **spec}
+
+    if spec["level"] not in LEVEL_LAYERS:
+        raise ValueError(f"level must be one of {list(LEVEL_LAYERS)}, got {spec['level']}")
+    if spec["format"] not in FORMATS:
+        raise ValueError(f"format must be one of {list(FORMATS)}, got {spec['format']}")
+    palette = spec["palette"].split(",") if isinstance(spec["palette"], str) else list(spec["palette"])
+    if len(palette) != 4:
+        raise ValueError(f"palette must have 4 corner colors, got {len(palette)}")
+    percentiles = float_list(spec["percentiles"])
+    if not percentiles or np.any(np.diff(percentiles) <= 0):
+        raise ValueError(f"percentiles must be increasing, got {percentiles}")
+    extent = float_list(spec["extent"])
+    if len(extent) != 4 or extent[0] >= extent[2] or extent[1] >= extent[3]:
+        raise ValueError(f"extent must be west, south, east, north, got {extent}")
+    size = [int(v) for v in float_list(spec["size"])]
+    if len(size) != 2 or min(size) <= 0 or max(size) > 8000:
+        raise ValueError(f"size must be width, height in pixels up to 8000, got {size}")
+    dpi = int(spec["dpi"])
+    if not 10 <= dpi <= 600:
+        raise ValueError(f"dpi must be between 10 and 600, got {dpi}")
+
+    flag = lambda value: value if isinstance(value, bool) else str(value).lower() in ["1", "true", "yes"]
+    return {
+        "feature": str(spec["feature"]),
+        "mh_feature": str(spec["mh_feature"]),
+        "level": spec["level"],
+        "palette": [color.strip().lower() for color in palette],
+        "percentiles": percentiles,
+        "extent": extent,
+        "format": spec["format"],
+        "size": size,
+        "dpi": dpi,
+        "basemap": flag(spec["basemap"]),
+        "title": flag(spec["title"]),
+    }
+
+
+def spec_key(spec, data_version):
+    """
+    Return the content address of the image of the normalized spec drawn from the data version
+    """
+    content = json.dumps([RENDER_VERSION, spec, data_version], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class RenderCache:
+    """
+    Content-addressed disk cache of the rendered images, bounded to max_bytes.
+    Every read touches the modification time of the image, and the images read least recently are evicted first.
+
+    Parameters:
+        path: str, the cache directory
+        max_bytes: int, the total size of the images kept
+    """
+
+    def __init__(self, path=fp.render_cache_dir, max_bytes=256 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def image_file(self, key, file_format):
+        return os.path.join(self.path, f"{key}.{file_format}")
+
+    def get(self, key, file_format):
+        """
+        Return the cached image bytes, None if the image is not cached
+        """
+        image_file = self.image_file(key, file_format)
+        try:
+            with open(image_file, "rb") as f:
+                data = f.read()
+            os.utime(image_file)
+        except FileNotFoundError:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        return data
+
+    def put(self, key, file_format, data):
+        image_file = self.image_file(key, file_format)
+        with open(image_file + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(image_file + ".tmp", image_file)
+        self.evict()
+        return None
+
+    def entries(self):
+        """
+        Return the (modification time, size, path) of every cached image, least recently used first
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Remove the least recently used images until the cache fits in max_bytes
+        """
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, image_file in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(image_file)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.stats["evictions"] += 1
+        return None
+
+    def info(self):
+        entries = self.entries()
+        return {
+            **self.stats,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+def level_colors(geo_df, spec):
+    """
+    Return the geodataframe of the level shapes and the RGBA color of every shape for the spec,
+    the urban centers are classified directly, the other levels on the means of their urban centers
+    """
+    feature, mh_feature = spec["feature"], spec["mh_feature"]
+    percentile = np.array(spec["percentiles"])
+    colorlist = mm.mikhailsirenko_colorscale(percentile, spec["palette"])
+    if spec["level"] == "Urban Center":
+        layer = geo_df[geo_df.geometry.notna()].reset_index(drop=True)
+        values = fa.normalize(fa.feature_array(layer, [feature, mh_feature]), "minmax")
+        env_classes = bn.classify(values[:, :1], percentile, reverse=True)
+        mh_classes = bn.classify(values[:, 1], percentile, reverse=True)
+    else:
+        layer, env_classes, mh_classes = mm.state_level_classes(
+            geo_df, [feature], mh_feature=mh_feature, percentile=percentile, level=spec["level"]
+        )
+    return layer, mm.class_colors(colorlist, env_classes, mh_classes)[:, 0], colorlist
+
+
+def draw_map(layer, colors, colorlist, spec, source=None):
+    """
+    Draw the colored layer in the extent of the spec on a new figure,
+    Return the image bytes in the format of the spec
+    """
+    width, height = spec["size"]
+    dpi = spec["dpi"]
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    canvas = FigureCanvasSVG(fig) if spec["format"] == "svg" else FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    w, s, e, n = spec["extent"]
+    ax.set_xlim(w, e)
+    ax.set_ylim(s, n)
+
+    lod = mm.lod_column(layer, ax)
+    layer = mm.with_lod(layer, lod)
+    # only the shapes in the extent are drawn
+    visible = np.sort(layer.sindex.query(shapely.box(w, s, e, n), predicate="intersects"))
+    if len(visible):
+        layer.iloc[visible].plot(ax=ax, color=colors[visible], edgecolor="black", linewidth=0.35)
+    ax.set_xlim(w, e)
+    ax.set_ylim(s, n)
+    if spec["basemap"]:
+        mm.add_basemap(ax, crs=layer.crs, source=source)
+    mm.bicolor_legend(
+        ax,
+        colorlist,
+        percentile=np.array(spec["percentiles"]),
+        legend_position=[0, 0.1, 0.1, 0.1],
+        tick_fontsize=5,
+        label_fontsize=5,
+        x_label="Mental Illness Score Index",
+        y_label=f"{spec['feature']} (Normalized)",
+    )
+    mm.set_off_axis(ax)
+    if spec["title"]:
+        ax.set_title(
+            label=f"Normalized Mental Illness Score and {spec['feature']} Score by {spec['level']}",
+            fontsize=10,
+        )
+    buf = io.BytesIO()
+    canvas.print_figure(buf, format=spec["format"], dpi=dpi, bbox_inches="tight")
+    return buf.getvalue()
+
+
+class MapRenderer:
+    """
+    Render map specs to image bytes through the render cache.
+
+    Parameters:
+        merged_path: str, the merged data file
+        cache_dir: str, the render cache directory, None to render every request
+        max_bytes: int, the size of the render cache
+        layers: dict of level to (geo file, merged join key, geo join key), LEVEL_LAYERS by default
+        source: the basemap source of the specs with basemap, the map_module source if None
+    """
+
+    def __init__(
+        self,
+        merged_path=fp.merged_data_file,
+        cache_dir=fp.render_cache_dir,
+        max_bytes=256 << 20,
+        layers=LEVEL_LAYERS,
+        source=None,
+    ):
+        self.merged_path = merged_path
+        self.cache = RenderCache(cache_dir, max_bytes) if cache_dir is not None else None
+        self.layers = layers
+        self.source = source
+        # matplotlib and the geo cache of map_module are not thread-safe, renders run one at a time
+        self.render_lock = threading.Lock()
+
+    def data_version(self, level):
+        """
+        Return the signatures of the geo file of the level and of the merged data file
+        """
+        geo_path = self.layers[level][0]
+        for file_path in [geo_path, self.merged_path]:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"the {level} layer file {file_path} is not available")
+        return [list(mm.file_signature(geo_path)), list(mm.file_signature(self.merged_path))]
+
+    def key(self, spec):
+        """
+        Return the normalized map spec and its cache key, without rendering it
+        """
+        spec = normalize_spec(spec)
+        if spec["level"] not in self.layers:
+            raise ValueError(f"level must be one of {list(self.layers)}, got {spec['level']}")
+        return spec, spec_key(spec, self.data_version(spec["level"]))
+
+    def render(self, spec):
+        """
+        Return the image bytes of the map spec, its content type, its cache key and whether it was cached
+        """
+        spec, key = self.key(spec)
+        content_type = FORMATS[spec["format"]]
+        data = self.cache.get(key, spec["format"]) if self.cache is not None else None
+        if data is not None:
+            return data, content_type, key, True
+
+        with self.render_lock:
+            # another request may have rendered the same map while this one waited
+            if self.cache is not None and os.path.exists(self.cache.image_file(key, spec["format"])):
+                return self.cache.get(key, spec["format"]), content_type, key, True
+            geo_path, lefton, righton = self.layers[spec["level"]]
+            columns = [spec["mh_feature"], spec["feature"]]
+            geo_df = mm.cached_merge_geo_df(geo_path, self.merged_path, lefton, righton)
+            missing = [col for col in columns if col not in geo_df.columns]
+            if missing:
+                raise ValueError(f"features not in the merged data: {missing}")
+            # the other levels are rolled up from the states of the urban centers
+            key_cols = [lefton] if spec["level"] == "Urban Center" else ["State", lefton]
+            geo_df = geo_df[list(dict.fromkeys(key_cols + columns + [geo_df.geometry.name] + mm.lod_cols(geo_df)))]
+            layer, colors, colorlist = level_colors(geo_df, spec)
+            data = draw_map(layer, colors, colorlist, spec, source=self.source)
+            if self.cache is not None:
+                self.cache.put(key, spec["format"], data)
+        return data, content_type, key, False
+
+
+class MapRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /map.png or /map.svg with the spec as query parameters, POST /map with the JSON spec,
+    GET /info for the cache statistics
+    """
+
+    renderer = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/info":
+            info = self.renderer.cache.info() if self.renderer.cache is not None else {}
+            self.send_bytes(json.dumps(info).encode(), "application/json")
+            return
+        name, _, file_format = url.path.strip("/").partition(".")
+        if name != "map":
+            self.send_error(404)
+            return
+        spec = dict(parse_qsl(url.query))
+        if file_format:
+            spec["format"] = file_format
+        self.send_map(spec)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/map":
+            self.send_error(404)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            spec = json.loads(body or b"{}")
+        except ValueError as e:
+            self.send_error(400, f"invalid JSON spec: {e}")
+            return
+        self.send_map(spec)
+
+    def send_map(self, spec):
+        try:
+            # a conditional request for an unchanged map is answered before rendering or reading it
+            _, key = self.renderer.key(spec)
+            if self.headers.get("If-None-Match") == f'"{key}"':
+                self.send_response(304)
+                self.send_header("ETag", f'"{key}"')
+                self.end_headers()
+                return
+            data, content_type, key, cached = self.renderer.render(spec)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e).strip("'\""))
+            return
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+            return
+        except Exception:
+            traceback.print_exc()
+            self.send_error(500, "the map could not be rendered")
+            return
+        self.send_bytes(data, content_type, {"ETag": f'"{key}"', "X-Render-Cache": "hit" if cached else "miss"})
+
+    def send_bytes(self, data, content_type, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return None
+
+
+def serve_maps(renderer=None, host="127.0.0.1", port=0):
+    """
+    Start the local map rendering server in a background thread.
+    Return the server, stop it with server.shutdown(), and its url.
+    """
+    renderer = renderer if renderer is not None else MapRenderer()
+    handler = type("Handler", (MapRequestHandler,), {"renderer": renderer})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    parser = argparse.ArgumentParser(description="Serve the bivariate choropleth maps as PNG or SVG images")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-dir", default=fp.render_cache_dir)
+    parser.add_argument("--cache-mb", type=int, default=256)
+    args = parser.parse_args()
+
+    renderer = MapRenderer(cache_dir=args.cache_dir, max_bytes=args.cache_mb << 20)
+    server, url = serve_maps(renderer, port=args.port)
+    print(f"Serving the maps at {url}map.png?feature=Avg%20Greenness&level=State, press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,257 @@
+import numbers
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import KDTree
+
+import file_path as fp
+
+### Similar urban center search over a KD-tree of the urban center features.
+### The features are standardized once (like sklearn StandardScaler), optionally weighted, and indexed in a KD-tree,
+### so the k most similar urban centers of any number of urban centers, or of all of them, are one vectorized query.
+### The index is saved next to the data with the signature of the data file, and rebuilt when the data changes.
+
+## example usage of SimilarityIndex, like findclosestucs in data_analysis.ipynb
+# index = sm.load_or_build_index(path.merged_data_file)
+# sm.find_closest_ucs(index, "Flint", k=5)
+# index.query(["Flint", "Cary"], k=5)
+# index.query([107], k=5)  # by UC_Grouping, for the names shared by urban centers of several states
+# index.query(k=3)  # top 3 of all urban centers
+
+SIGNICOLS = [
+    "Avg Elevation",
+    "Avg Precipitation",
+    "Avg Greenness",
+    "% of Pop in High Green Area",
+    "% of Open Spaces",
+]
+METRICS = {"euclidean": 2, "manhattan": 1, "chebyshev": np.inf}
+
+
+def standardize(x, mean=None, scale=None):
+    """
+    Standardize the columns of the 2d array to zero mean and unit variance, constant columns are only centered,
+    Return the standardized array, the column means and scales
+    """
+    mean = np.nanmean(x, axis=0) if mean is None else mean
+    if scale is None:
+        scale = np.nanstd(x, axis=0)
+        scale[scale == 0] = 1
+    return (x - mean) / scale, mean, scale
+
+
+def weight_scale(features, weights=None, metric="euclidean"):
+    """
+    Return the factor of every standardized feature, so the Minkowski distance of the scaled features
+    is the weighted distance: sum(w * |d| ** p) ** (1 / p), or max(w * |d|) for chebyshev
+    """
+    if weights is None:
+        return np.ones(len(features))
+    if isinstance(weights, dict):
+        weights = [weights.get(feature, 1) for feature in features]
+    weights = np.asarray(weights, dtype=float)
+    p = METRICS[metric]
+    return weights if np.isinf(p) else weights ** (1 / p)
+
+
+class SimilarityIndex:
+    """
+    KD-tree of the standardized and weighted features of the urban centers.
+
+    Parameters:
+        df: dataframe, one row per urban center
+        features: list, the feature columns compared, SIGNICOLS by default
+        label_col: str, the urban center name column used in queries
+        id_col: str, the urban center key column, kept in the results and usable in queries when present in df
+        state_col: str, the state column, kept in the results when present in df
+        weights: dict of feature to weight or list of weights, equal weights if None
+        metric: str, euclidean, manhattan or chebyshev
+        leafsize: int, the leaf size of the KD-tree
+    Urban centers with a missing feature are left out of the index.
+    """
+
+    def __init__(
+        self,
+        df,
+        features=SIGNICOLS,
+        label_col="Urban Center",
+        id_col="UC_Grouping",
+        state_col="State",
+        weights=None,
+        metric="euclidean",
+        leafsize=16,
+    ):
+        if metric not in METRICS:
+            raise ValueError(f"metric must be one of {list(METRICS)}, got {metric}")
+        self.features = list(features)
+        self.label_col = label_col
+        self.id_col = id_col if id_col in df.columns else None
+        self.state_col = state_col if state_col in df.columns else None
+        self.metric = metric
+        self.p = METRICS[metric]
+
+        x = df[self.features].to_numpy(dtype=float)
+        complete = ~np.isnan(x).any(axis=1)
+        z, self.mean, self.scale = standardize(x[complete])
+        self.weights = weight_scale(self.features, weights, metric)
+        self.labels = df[label_col].to_numpy()[complete]
+        self.ids = df[self.id_col].to_numpy()[complete] if self.id_col else np.arange(len(z))
+        self.states = df[self.state_col].to_numpy()[complete] if self.state_col else None
+        self.tree = KDTree(z * self.weights, leafsize=leafsize)
+        self.source = None
+
+    def __len__(self):
+        return self.tree.n
+
+    def transform(self, values):
+        """
+        Standardize and weight feature rows like the indexed urban centers
+        """
+        x = np.asarray(values, dtype=float).reshape(-1, len(self.features))
+        return standardize(x, self.mean, self.scale)[0] * self.weights
+
+    def positions(self, names):
+        """
+        Return the index position of every urban center, given by its name or by its id_col key.
+        Raise a KeyError for the urban centers not in the index,
+        and a ValueError for a name shared by several urban centers, which must be given by its key instead.
+        """
+        by_label = pd.Series(np.arange(len(self.labels))).groupby(self.labels).agg(list)
+        positions, missing = [], []
+        for name in names:
+            if isinstance(name, numbers.Integral) and self.id_col:
+                found = np.flatnonzero(self.ids == name).tolist()
+            else:
+                found = by_label.get(name, [])
+            if not found:
+                missing.append(name)
+            elif len(found) > 1:
+                candidates = ", ".join(f"{self.ids[i]} ({self.display_label(i)})" for i in found)
+                raise ValueError(f"{name} names several urban centers, query one by {self.id_col}: {candidates}")
+            else:
+                positions.append(found[0])
+        if missing:
+            raise KeyError(f"urban centers not in the index: {missing}")
+        return np.array(positions, dtype=int)
+
+    def display_label(self, position):
+        """
+        Return the urban center name at the position, qualified by its state as "Rochester, NY" when the index has the states
+        """
+        if self.states is None:
+            return self.labels[position]
+        return f"{self.labels[position]}, {self.states[position]}"
+
+    def query(self, names=None, k=5):
+        """
+        Find the k most similar urban centers of every named urban center, of all urban centers if names is None,
+        the urban center itself excluded.
+        Return the long dataframe of the query, rank, similar urban center and distance.
+        """
+        positions = np.arange(len(self)) if names is None else self.positions(names)
+        k = min(k, len(self) - 1)
+        distances, neighbors = self.tree.query(
+            self.tree.data[positions], k=k + 1, p=self.p
+        )
+        distances, neighbors = distances.reshape(len(positions), -1), neighbors.reshape(len(positions), -1)
+
+        # drop the urban center itself, or the farthest neighbor when ties pushed it out of the results
+        keep = neighbors != positions[:, np.newaxis]
+        keep[keep.all(axis=1), -1] = False
+        neighbors = neighbors[keep].reshape(len(positions), k)
+        distances = distances[keep].reshape(len(positions), k)
+        return self.results(positions, neighbors, distances)
+
+    def query_features(self, values, k=5):
+        """
+        Find the k most similar urban centers of feature rows that are not in the index,
+        Return the long dataframe of the query row, rank, similar urban center and distance
+        """
+        points = self.transform(values)
+        k = min(k, len(self))
+        distances, neighbors = self.tree.query(points, k=k, p=self.p)
+        distances, neighbors = distances.reshape(len(points), -1), neighbors.reshape(len(points), -1)
+        return self.results(None, neighbors, distances)
+
+    def results(self, positions, neighbors, distances):
+        n, k = neighbors.shape
+        rows = np.repeat(np.arange(n), k)
+        results = {}
+        if positions is None:
+            results["Query"] = rows
+        else:
+            if self.id_col:
+                results[self.id_col] = self.ids[positions][rows]
+            results[self.label_col] = self.labels[positions][rows]
+            if self.state_col:
+                results[self.state_col] = self.states[positions][rows]
+        results["Rank"] = np.tile(np.arange(1, k + 1), n)
+        if self.id_col:
+            results[f"Similar {self.id_col}"] = self.ids[neighbors.ravel()]
+        results[f"Similar {self.label_col}"] = self.labels[neighbors.ravel()]
+        if self.state_col:
+            results[f"Similar {self.state_col}"] = self.states[neighbors.ravel()]
+        results["Distance"] = distances.ravel()
+        return pd.DataFrame(results)
+
+    def save(self, file_path):
+        """
+        Pickle the index to file_path
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path + ".tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file_path + ".tmp", file_path)
+        return None
+
+
+def find_closest_ucs(index, urban_center, k=1):
+    """
+    Return the list of (urban center, distance) of the k urban centers most similar to urban_center,
+    like findclosestucs in data_analysis.ipynb, with the names qualified by their state as "Rochester, NY".
+    urban_center is a name, or the id_col key of a name shared by several urban centers.
+    """
+    closest = index.query([urban_center], k=k)
+    names = closest[f"Similar {index.label_col}"]
+    if index.state_col:
+        names = names.str.cat(closest[f"Similar {index.state_col}"].astype(str), sep=", ")
+    return list(zip(names, closest["Distance"]))
+
+
+def load_or_build_index(
+    data_path=fp.merged_data_file,
+    features=SIGNICOLS,
+    label_col="Urban Center",
+    state_col="State",
+    weights=None,
+    metric="euclidean",
+    index_path=fp.similarity_index_file,
+):
+    """
+    Load the similarity index saved at index_path if it was built from the same data file and parameters,
+    otherwise build it from data_path and save it
+    """
+    stat = os.stat(data_path)
+    source = {
+        "data": (os.path.abspath(data_path), stat.st_mtime_ns, stat.st_size),
+        "features": list(features),
+        "label_col": label_col,
+        "state_col": state_col,
+        "weights": weights,
+        "metric": metric,
+    }
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+        if index.source == source:
+            return index
+
+    df = pd.read_csv(data_path, index_col=0)
+    index = SimilarityIndex(
+        df, features, label_col=label_col, state_col=state_col, weights=weights, metric=metric
+    )
+    index.source = source
+    index.save(index_path)
+    return index
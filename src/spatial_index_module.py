@@ -0,0 +1,145 @@
+import os
+import pickle
+
+import numpy as np
+import shapely
+
+import file_path as fp
+
+### Spatial index of the urban center footprints and of the state polygons, shared by map_module and the cleaning pipeline.
+### The geometries of a geo layer are bulk-loaded once in a shapely STRtree, which answers bounding box,
+### point-in-polygon and nearest queries for many boxes or points at a time without scanning every geometry.
+### The index is pickled next to its geo file with the signature of the file, and rebuilt when the file changes.
+
+## example usage of SpatialIndex
+# uc_index = si.load_or_build_index(path.geo_us_asset, key_col="UC_Grouping")
+# uc_index.query_bbox(-84, 42.9, -83.5, 43.2)  # urban centers in the viewport
+# uc_index.query_point(-83.69, 43.01)  # urban centers containing the point
+# uc_index.nearest(-83.69, 43.01)  # nearest urban center
+
+
+class SpatialIndex:
+    """
+    STRtree over the geometries of a geo layer, returning the key of the geometries found.
+
+    Parameters:
+        geometry: array or GeoSeries of shapely geometries, missing geometries are left out
+        keys: array, the key of every geometry, like UC_Grouping or STUSPS
+        crs: the crs of the geometries, the queries are in the same crs
+    """
+
+    def __init__(self, geometry, keys, crs=None):
+        geometry = np.asarray(geometry, dtype=object)
+        valid = ~shapely.is_missing(geometry) & ~shapely.is_empty(geometry)
+        self.geometries = geometry[valid]
+        self.keys = np.asarray(keys)[valid]
+        self.crs = crs
+        self.tree = shapely.STRtree(self.geometries)
+        self.source = None
+
+    @classmethod
+    def from_gdf(cls, gdf, key_col):
+        """
+        Index the geometries of the geodataframe by key_col
+        """
+        return cls(gdf.geometry.to_numpy(), gdf[key_col].to_numpy(), crs=gdf.crs)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def query_bbox(self, xmin, ymin, xmax, ymax, predicate="intersects"):
+        """
+        Return the keys of the geometries intersecting the bounding box, or matching another shapely predicate
+        """
+        found = self.tree.query(shapely.box(xmin, ymin, xmax, ymax), predicate=predicate)
+        return self.keys[np.sort(found)]
+
+    def query_points(self, x, y):
+        """
+        Find the geometries containing every point of the x and y arrays in one query,
+        Return the (point position, key) arrays of the matches, sorted by point then geometry order
+        """
+        points = shapely.points(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        point_idx, geometry_idx = self.tree.query(points, predicate="within")
+        order = np.lexsort((geometry_idx, point_idx))
+        return point_idx[order], self.keys[geometry_idx[order]]
+
+    def query_point(self, x, y):
+        """
+        Return the keys of the geometries containing the point
+        """
+        return self.query_points([x], [y])[1]
+
+    def first_containing(self, x, y, missing=None):
+        """
+        Return the key of the first geometry containing every point, missing for points outside all geometries
+        """
+        point_idx, keys = self.query_points(x, y)
+        point_idx, first = np.unique(point_idx, return_index=True)
+        found = np.full(len(np.atleast_1d(x)), missing, dtype=object)
+        found[point_idx] = keys[first]
+        return found
+
+    def nearest(self, x, y, max_distance=None):
+        """
+        Return the key of the nearest geometry of every point and the distances, in the units of the crs,
+        a point inside a geometry is at distance 0, scalars return a single key and distance
+        """
+        points = shapely.points(np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float)))
+        (point_idx, geometry_idx), distances = self.tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=False
+        )
+        keys = np.full(len(points), None, dtype=object)
+        distance = np.full(len(points), np.nan)
+        keys[point_idx] = self.keys[geometry_idx]
+        distance[point_idx] = distances
+        if np.ndim(x) == 0:
+            return keys[0], distance[0]
+        return keys, distance
+
+    def save(self, file_path):
+        """
+        Pickle the index to file_path, the STRtree is rebuilt from the geometries when loaded
+        """
+        with open(file_path + ".tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file_path + ".tmp", file_path)
+        return None
+
+
+def index_file(geo_path, key_col):
+    """
+    Return the path of the spatial index saved alongside the geo file
+    """
+    return f"{os.path.splitext(geo_path)[0]}.{key_col}.sindex.pkl"
+
+
+def read_geo_layer(geo_path, key_col):
+    """
+    Read the key and geometry of a geo asset, geojson or shapefile
+    """
+    import geopandas as gpd
+
+    if geo_path.endswith(".parquet"):
+        return gpd.read_parquet(geo_path, columns=[key_col, "geometry"])
+    return gpd.read_file(geo_path)[[key_col, "geometry"]]
+
+
+def load_or_build_index(geo_path=fp.geo_us_asset, key_col="UC_Grouping", index_path=None):
+    """
+    Load the spatial index saved alongside the geo file if it was built from the same file,
+    otherwise build it from the geo file and save it
+    """
+    index_path = index_path or index_file(geo_path, key_col)
+    stat = os.stat(geo_path)
+    source = (os.path.abspath(geo_path), stat.st_mtime_ns, stat.st_size, key_col)
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+        if index.source == source:
+            return index
+
+    index = SpatialIndex.from_gdf(read_geo_layer(geo_path, key_col), key_col)
+    index.source = source
+    index.save(index_path)
+    return index
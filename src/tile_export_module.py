@@ -0,0 +1,325 @@
+import io
+import json
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_hex
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+import shapely
+
+import file_path as fp
+import geo_asset_module as ga
+import hierarchy_module as hr
+import map_module as mm
+import tile_module as tm
+
+### Export of the choropleth layers as a tile pyramid, replacing the GeoJSON embedded in the folium html pages.
+### Every zoom level is written as an XYZ directory of pre-rendered PNG tiles ({z}/{x}/{y}.png), and of small
+### GeoJSON attribute tiles ({z}/{x}/{y}.geojson) holding the features clipped to the tile with their
+### MH_Score and env attributes for the tooltips, so a browser only fetches the tiles of the visible extent.
+### The geometries are drawn from the level of detail of the geo asset that fits the zoom.
+
+## example usage of export_tiles, then view the tiles at the printed url
+# layer = tx.choropleth_layer(geo_df, "Avg Greenness")
+# tx.export_tiles(layer, os.path.join(fp.tile_export_dir, "urban_centers"), zooms=range(3, 10))
+# server, url = tx.serve_directory(fp.tile_export_dir)
+
+TILE_ZOOMS = range(3, 10)
+VIEWER_FILE = "index.html"
+
+
+def choropleth_layer(
+    geo_df,
+    env_feature,
+    mh_feature="MH_Score",
+    attribute_cols=["Urban Center", "State"],
+    level=None,
+    percentile=np.linspace(0.33, 1, 3),
+    color_list=["#ffb000", "#dc267f", "#648fff", "#785ef0"],
+):
+    """
+    Return the layer geodataframe of the bivariate choropleth map in longitude/latitude,
+    with its fill color, the raw mh_feature, env_feature and attribute_cols, and its levels of detail.
+
+    Parameters:
+        geo_df: geodataframe, the output of merge_geo_df
+        env_feature: str, the environmental feature
+        mh_feature: str, the mental health feature
+        attribute_cols: list, the extra columns shown in the tooltips, the urban center level only
+        level: str, None for the urban centers, or "State", "Division" or "Region" to average them
+            by that level like one_function_bimap_state_level, geo_df then holds the geometries of the level
+            and the State column of every urban center
+        percentile: array, the class upper bounds of the normalized features
+        color_list: list, the 4 corner hex colors of the bivariate color grid
+    """
+    layer = geo_df[geo_df.geometry.notna()]
+    values = [mh_feature, env_feature]
+    if level is not None:
+        if level not in hr.LEVELS:
+            raise ValueError(f"level must be None or one of {hr.LEVELS}, got {level}")
+        hierarchy = hr.build_hierarchy(layer["State"])
+        level_df = hr.rollup(layer[values], hierarchy, level)
+        layer = hr.join_geometry(level_df, layer, level, extra_cols=mm.lod_cols(layer))
+        attribute_cols = [level]
+    layer = layer[attribute_cols + values + [layer.geometry.name] + mm.lod_cols(layer)]
+    layer = layer.reset_index(drop=True)
+
+    normalized_df = mm.normalize_features(layer, env_feature, mh_feature=mh_feature)
+    color_df = mm.assign_color_cells(
+        normalized_df, env_feature, mh_col=mh_feature, percentile=percentile
+    )
+    colorlist = mm.mikhailsirenko_colorscale(percentile, color_list)
+    colored = color_df["c1_env"].notna() & color_df["c2_mh"].notna()
+    rgb = colorlist[
+        color_df["c1_env"][colored].astype(int).to_numpy(), color_df["c2_mh"][colored].astype(int).to_numpy()
+    ]
+    layer = layer[colored.to_numpy()].reset_index(drop=True)
+    layer["fill"] = [to_hex(c) for c in rgb]
+    if layer.crs is not None and not layer.crs.equals("EPSG:4326"):
+        layer = layer.to_crs("EPSG:4326")
+    return layer
+
+
+def zoom_lod(layer, zoom):
+    """
+    Return the coarsest level of detail column of the layer whose tolerance is below a pixel at the zoom,
+    None for the full geometries
+    """
+    pixel_size = 360 / (tm.TILE_SIZE * 2**zoom)
+    fitting = [col for col in mm.lod_cols(layer) if ga.LOD_TOLERANCES[col] <= pixel_size]
+    return max(fitting, key=ga.LOD_TOLERANCES.get) if fitting else None
+
+
+def layer_tiles(layer, zoom):
+    """
+    Yield every tile of the zoom covering a feature of the layer, with the rows of its features,
+    found once per tile through the spatial index of the layer
+    """
+    import mercantile
+
+    w, s, e, n = layer.total_bounds
+    for tile in mercantile.tiles(w, max(s, -85.0511), e, min(n, 85.0511), zooms=[zoom]):
+        bounds = mercantile.bounds(tile)
+        rows = layer.sindex.query(shapely.box(*bounds), predicate="intersects")
+        if len(rows):
+            yield tile, np.sort(rows)
+
+
+def tile_figure():
+    """
+    Return a figure and axes drawing exactly one 256x256 tile, with no margins or axis,
+    on its own Agg canvas so that the pyplot backend is left alone
+    """
+    fig = Figure(figsize=(1, 1), dpi=tm.TILE_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    return fig, ax
+
+
+def render_tile(fig, ax, layer, rows, bounds, edge_color="black", line_width=0.35, alpha=0.8):
+    """
+    Draw the rows of the web mercator layer in the tile bounds (left, bottom, right, top),
+    Return the transparent PNG bytes
+    """
+    ax.clear()
+    tile_df = layer.iloc[rows]
+    tile_df.plot(
+        ax=ax, color=tile_df["fill"].tolist(), alpha=alpha, edgecolor=edge_color, linewidth=line_width
+    )
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    ax.set_aspect("auto")
+    ax.set_axis_off()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", transparent=True)
+    return buf.getvalue()
+
+
+def geojson_tile(geometry, records, rows, bounds):
+    """
+    Return the GeoJSON feature collection of the rows clipped to the longitude/latitude tile bounds,
+    with their attribute records as properties
+    """
+    clipped = shapely.clip_by_rect(geometry[rows], *bounds)
+    features = [
+        {"type": "Feature", "geometry": json.loads(geojson), "properties": records[row]}
+        for row, geojson in zip(rows, shapely.to_geojson(clipped))
+    ]
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":"))
+
+
+def json_records(df):
+    """
+    Return the rows of the dataframe as JSON-safe dictionaries, missing values as None
+    """
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict("records")
+
+
+def write_file(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(file_path, mode) as f:
+        f.write(data)
+    return None
+
+
+def export_tiles(
+    layer,
+    out_dir,
+    zooms=TILE_ZOOMS,
+    attributes=True,
+    edge_color="black",
+    line_width=0.35,
+    alpha=0.8,
+):
+    """
+    Write the tile pyramid of a choropleth layer and its viewer page.
+
+    Parameters:
+        layer: geodataframe, the output of choropleth_layer
+        out_dir: str, the directory of the {z}/{x}/{y} tiles
+        zooms: range, the zoom levels to export
+        attributes: bool, also write the GeoJSON attribute tiles for the tooltips
+        edge_color, line_width, alpha: the style of the polygons
+    Return the number of tiles written per zoom, tiles without features are not written.
+    """
+    import mercantile
+
+    attribute_cols = [col for col in layer.columns if col not in [layer.geometry.name, "fill"] + mm.lod_cols(layer)]
+    records = json_records(pd.DataFrame(layer[attribute_cols]))
+    fig, ax = tile_figure()
+    counts = {}
+    for zoom in zooms:
+        # one level of detail and one projection per zoom, shared by all its tiles
+        lod_layer = mm.with_lod(layer, zoom_lod(layer, zoom))
+        mercator = lod_layer.to_crs("EPSG:3857")
+        geometry = lod_layer.geometry.to_numpy()
+        counts[zoom] = 0
+        for tile, rows in layer_tiles(lod_layer, zoom):
+            tile_file = os.path.join(out_dir, str(tile.z), str(tile.x), str(tile.y))
+            png = render_tile(
+                fig, ax, mercator, rows, mercantile.xy_bounds(tile), edge_color, line_width, alpha
+            )
+            write_file(tile_file + ".png", png)
+            if attributes:
+                write_file(tile_file + ".geojson", geojson_tile(geometry, records, rows, mercantile.bounds(tile)))
+            counts[zoom] += 1
+
+    metadata = {
+        "bounds": [float(v) for v in layer.total_bounds],
+        "minzoom": min(zooms),
+        "maxzoom": max(zooms),
+        "attributes": attribute_cols,
+        "geojson": attributes,
+        "tiles": counts,
+    }
+    write_file(os.path.join(out_dir, "metadata.json"), json.dumps(metadata, indent=1))
+    write_file(os.path.join(out_dir, VIEWER_FILE), viewer_html(metadata))
+    return counts
+
+
+def viewer_html(metadata):
+    """
+    Return the Leaflet page showing the PNG tiles over OpenStreetMap,
+    with tooltips from the GeoJSON attribute tiles of the visible extent
+    """
+    w, s, e, n = metadata["bounds"]
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{ height: 100%; margin: 0; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const minZoom = {metadata["minzoom"]}, maxZoom = {metadata["maxzoom"]};
+const map = L.map("map", {{minZoom: minZoom}}).fitBounds([[{s}, {w}], [{n}, {e}]]);
+L.tileLayer("https://tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png", {{
+  attribution: "&copy; OpenStreetMap contributors"
+}}).addTo(map);
+L.tileLayer("{{z}}/{{x}}/{{y}}.png", {{minZoom: minZoom, maxNativeZoom: maxZoom, maxZoom: 19}}).addTo(map);
+
+if ({json.dumps(metadata["geojson"])}) {{
+  // invisible features of the visible attribute tiles, only used for the tooltips
+  const AttributeTiles = L.GridLayer.extend({{
+    createTile: function (coords, done) {{
+      const tile = document.createElement("div");
+      const key = this._tileCoordsToKey(coords);
+      if (coords.z < minZoom || coords.z > maxZoom) {{ setTimeout(() => done(null, tile)); return tile; }}
+      fetch(`${{coords.z}}/${{coords.x}}/${{coords.y}}.geojson`)
+        .then((response) => (response.ok ? response.json() : null))
+        .then((data) => {{
+          if (data && this._tiles[key]) {{
+            this._features[key] = L.geoJSON(data, {{
+              style: {{opacity: 0, fillOpacity: 0}},
+              onEachFeature: (feature, layer) => layer.bindTooltip(
+                Object.entries(feature.properties).map(([k, v]) => `${{k}}: ${{v ?? "N/A"}}`).join("<br>"), {{sticky: true}})
+            }}).addTo(map);
+          }}
+          done(null, tile);
+        }});
+      return tile;
+    }}
+  }});
+  const attributes = new AttributeTiles({{minZoom: minZoom, maxNativeZoom: maxZoom}});
+  attributes._features = {{}};
+  attributes.on("tileunload", (event) => {{
+    const key = attributes._tileCoordsToKey(event.coords);
+    if (attributes._features[key]) {{ map.removeLayer(attributes._features[key]); delete attributes._features[key]; }}
+  }});
+  attributes.addTo(map);
+}}
+</script>
+</body>
+</html>
+"""
+
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    extensions_map = {**SimpleHTTPRequestHandler.extensions_map, ".geojson": "application/geo+json"}
+
+    def log_message(self, format, *args):
+        return None
+
+
+def serve_directory(path=fp.tile_export_dir, host="127.0.0.1", port=0):
+    """
+    Start a local static file server of the exported tiles in a background thread,
+    open the url of a layer directory in a browser to view its tiles.
+    Return the server, stop it with server.shutdown(), and its url.
+    """
+    handler = partial(QuietRequestHandler, directory=path)
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the urban center choropleth layer as tiles and serve them")
+    parser.add_argument("--env-feature", default="Avg Greenness")
+    parser.add_argument("--zooms", type=int, nargs=2, default=[TILE_ZOOMS.start, TILE_ZOOMS.stop - 1])
+    parser.add_argument("--out", default=os.path.join(fp.tile_export_dir, "urban_centers"))
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    geo_df = mm.merge_geo_df(fp.geo_us_asset, fp.merged_data_file, "UC_Grouping", "UC_Grouping")
+    layer = choropleth_layer(geo_df, args.env_feature)
+    counts = export_tiles(layer, args.out, zooms=range(args.zooms[0], args.zooms[1] + 1))
+    print(f"{sum(counts.values())} tiles written to {args.out}.")
+    server, url = serve_directory(args.out, port=args.port)
+    print(f"Serving the tiles at {url}, press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
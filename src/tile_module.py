@@ -0,0 +1,321 @@
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import file_path as fp
+
+### Disk-backed basemap tile cache, so maps can be drawn without network access.
+### Tiles are stored as an XYZ directory ({z}/{x}/{y}.png) or in a single .mbtiles file,
+### and the tiles covering a map extent are stitched once into a GeoTIFF mosaic that
+### contextily reads as a local basemap source, so later maps of the same extent reuse it.
+
+## example usage of TileCache, seed the tiles once while online, then draw offline
+# cache = TileCache(fp.tile_cache_dir, download=True)
+# cache.seed(US_BBOX, zooms=range(3, 7))
+# map.set_basemap_source(TileCache(fp.tile_cache_dir))
+
+US_BBOX = (-125, 24, -66.5, 50)  # west, south, east, north
+TILE_SIZE = 256
+
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+def key_lock(*key):
+    """
+    Return the lock of the key, shared by every TileCache of the process,
+    so one tile or mosaic is fetched and written by one thread at a time
+    """
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def temp_file(file_path):
+    """
+    Return a new temporary file path in the directory of file_path, unique to the writer,
+    to write to before replacing file_path
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path), prefix=os.path.basename(file_path) + ".", suffix=".tmp"
+    )
+    os.close(fd)
+    return tmp_path
+
+
+def default_provider():
+    """
+    Return the OpenStreetMap Mapnik tile provider used by the maps
+    """
+    import xyzservices.providers as xyz
+
+    return xyz.OpenStreetMap.Mapnik
+
+
+def auto_zoom(w, s, e, n, max_zoom=19):
+    """
+    Choose the zoom level of a longitude/latitude bounding box, like contextily zoom="auto"
+    """
+    zoom_lon = np.ceil(np.log2(360 * 2.0 / abs(e - w)))
+    zoom_lat = np.ceil(np.log2(360 * 2.0 / abs(n - s)))
+    return int(min(zoom_lon, zoom_lat, max_zoom))
+
+
+class TileCache:
+    """
+    Disk-backed cache of the tiles of one provider.
+
+    Parameters:
+        path: str, the XYZ cache directory, or a .mbtiles file
+        provider: xyzservices TileProvider or url template with {z}, {x} and {y}, OpenStreetMap Mapnik by default
+        download: bool, fetch the tiles missing from the cache, otherwise they are left blank
+        user_agent: str, the User-Agent header sent to the tile provider
+    """
+
+    def __init__(
+        self, path=fp.tile_cache_dir, provider=None, download=False, user_agent="Natures_Rx"
+    ):
+        self.provider = provider if provider is not None else default_provider()
+        self.path = path
+        self.download = download
+        self.user_agent = user_agent
+        self.mbtiles = path.endswith(".mbtiles")
+        if isinstance(self.provider, str):
+            self.name = "url_" + hashlib.sha256(self.provider.encode()).hexdigest()[:12]
+            self.max_zoom = 19
+        else:
+            self.name = self.provider.name.replace(".", "_")
+            self.max_zoom = self.provider.get("max_zoom", 19)
+        if self.mbtiles:
+            with sqlite3.connect(self.path) as con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+                    "tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))"
+                )
+
+    def url(self, z, x, y):
+        if isinstance(self.provider, str):
+            return self.provider.format(z=z, x=x, y=y)
+        return self.provider.build_url(x=x, y=y, z=z)
+
+    def tile_file(self, z, x, y):
+        return os.path.join(self.path, self.name, str(z), str(x), f"{y}.png")
+
+    def read(self, z, x, y):
+        """
+        Return the cached tile image bytes, None if the tile is not cached
+        """
+        if self.mbtiles:
+            # MBTiles rows follow the TMS scheme, with y counted from the south
+            with sqlite3.connect(self.path) as con:
+                row = con.execute(
+                    "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                    (z, x, 2**z - 1 - y),
+                ).fetchone()
+            return row[0] if row else None
+        try:
+            with open(self.tile_file(z, x, y), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, z, x, y):
+        """
+        Return the tile image bytes, downloading it when missing and download is True, None if unavailable
+        """
+        data = self.read(z, x, y)
+        if data is None and self.download:
+            with key_lock(os.path.abspath(self.path), self.name, z, x, y):
+                # another thread may have downloaded the tile while this one waited
+                data = self.read(z, x, y)
+                if data is None:
+                    data = self.fetch(z, x, y)
+                    self.put(z, x, y, data)
+        return data
+
+    def put(self, z, x, y, data):
+        if self.mbtiles:
+            with sqlite3.connect(self.path) as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, 2**z - 1 - y, data)
+                )
+        else:
+            tile_file = self.tile_file(z, x, y)
+            os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+            tmp_file = temp_file(tile_file)
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            os.replace(tmp_file, tile_file)
+        return None
+
+    def fetch(self, z, x, y, timeout=30):
+        import requests
+
+        response = requests.get(
+            self.url(z, x, y), headers={"User-Agent": self.user_agent}, timeout=timeout
+        )
+        response.raise_for_status()
+        return response.content
+
+    def seed(self, bbox=US_BBOX, zooms=range(3, 7)):
+        """
+        Download every missing tile of the longitude/latitude bbox (west, south, east, north) at the zooms,
+        Return the number of tiles in the cache for the bbox
+        """
+        import mercantile
+
+        download, self.download = self.download, True
+        try:
+            tiles = list(mercantile.tiles(*bbox, zooms=list(zooms)))
+            for tile in tiles:
+                self.get(tile.z, tile.x, tile.y)
+        finally:
+            self.download = download
+        return len(tiles)
+
+    def mosaic(self, w, s, e, n, zoom="auto"):
+        """
+        Stitch the cached tiles covering the longitude/latitude bbox into a web mercator GeoTIFF,
+        Return the GeoTIFF path, reused as is when the same tiles were already stitched.
+        Tiles missing from the cache are left transparent.
+        """
+        import mercantile
+
+        if zoom == "auto":
+            zoom = auto_zoom(w, s, e, n, self.max_zoom)
+        tiles = list(mercantile.tiles(w, s, e, n, zooms=[zoom]))
+        xs = [t.x for t in tiles]
+        ys = [t.y for t in tiles]
+        x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+
+        cache_dir = self.path + "_mosaics" if self.mbtiles else os.path.join(self.path, "mosaics")
+        mosaic_file = os.path.join(cache_dir, f"{self.name}_{zoom}_{x0}_{y0}_{x1}_{y1}.tif")
+        # one thread stitches a mosaic, the others wait and reuse it
+        with key_lock(os.path.abspath(mosaic_file)):
+            if os.path.exists(mosaic_file):
+                return mosaic_file
+
+            image = np.zeros(((y1 - y0 + 1) * TILE_SIZE, (x1 - x0 + 1) * TILE_SIZE, 4), np.uint8)
+            missing = 0
+            for tile in tiles:
+                data = self.get(tile.z, tile.x, tile.y)
+                if data is None:
+                    missing += 1
+                    continue
+                row, col = (tile.y - y0) * TILE_SIZE, (tile.x - x0) * TILE_SIZE
+                image[row : row + TILE_SIZE, col : col + TILE_SIZE] = decode_tile(data)
+            if missing:
+                # an incomplete mosaic is rebuilt on the next call, once the tiles may have been seeded
+                print(f"{missing} of {len(tiles)} basemap tiles at zoom {zoom} are not cached.")
+                mosaic_file = mosaic_file.replace(".tif", "_partial.tif")
+
+            left, _, _, top = mercantile.xy_bounds(x0, y0, zoom)
+            _, bottom, right, _ = mercantile.xy_bounds(x1, y1, zoom)
+            os.makedirs(cache_dir, exist_ok=True)
+            write_geotiff(image, (left, bottom, right, top), mosaic_file)
+            return mosaic_file
+
+    def mosaic_for_axes(self, ax, crs, zoom="auto"):
+        """
+        Return the GeoTIFF mosaic covering the current extent of the axes drawn in crs
+        """
+        from pyproj import Transformer
+
+        xmin, xmax, ymin, ymax = ax.axis()
+        w, s, e, n = Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform_bounds(
+            xmin, ymin, xmax, ymax
+        )
+        # web mercator tiles stop at +/- 85.0511 degrees latitude
+        s, n = max(s, -85.0511), min(n, 85.0511)
+        return self.mosaic(w, s, e, n, zoom=zoom)
+
+
+def decode_tile(data):
+    """
+    Decode the tile image bytes into a (256, 256, 4) RGBA array
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        return np.asarray(img.convert("RGBA"))
+
+
+def write_geotiff(image, bounds, file_path):
+    """
+    Write the RGBA image covering the web mercator bounds (left, bottom, right, top) as a GeoTIFF
+    """
+    import rasterio
+    from rasterio.transform import from_bounds
+
+    height, width = image.shape[:2]
+    tmp_file = temp_file(file_path)
+    with rasterio.open(
+        tmp_file,
+        "w",
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=4,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_bounds(*bounds, width, height),
+    ) as dst:
+        dst.write(np.moveaxis(image, -1, 0))
+    os.replace(tmp_file, file_path)
+    return None
+
+
+@lru_cache(maxsize=2)
+def blank_tile(shade=200):
+    """
+    Return a plain grey PNG tile
+    """
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (shade, shade, shade, 255)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        try:
+            z, x, y = [int(v) for v in self.path.split("?")[0].strip("/").rsplit(".", 1)[0].split("/")[-3:]]
+        except ValueError:
+            self.send_error(400)
+            return
+        if self.cache is None:
+            data = blank_tile(200 if (x + y) % 2 else 230)
+        else:
+            data = self.cache.get(z, x, y)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return None
+
+
+def serve_tiles(cache=None, host="127.0.0.1", port=0):
+    """
+    Start a local tile server in a background thread, a stand-in for the tile provider in tests.
+    It serves /{z}/{x}/{y}.png from the tile cache, or grey checkerboard tiles when cache is None.
+    Return the server, stop it with server.shutdown(), and its url template.
+    """
+    handler = type("Handler", (TileRequestHandler,), {"cache": cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png"